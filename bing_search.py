@@ -1,9 +1,95 @@
 import os
 import argparse
 import json
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backoff
+import requests
+from requests.adapters import HTTPAdapter
+
+from dsp.utils.rate_limit import TokenBucket, parse_duration
+from utils import write_jsonl_atomic
+
+
+class RetryableSearchError(Exception):
+    pass
+
+
+def backoff_hdlr(details):
+    print("Backing off {wait:0.1f} seconds after {tries} tries".format(**details))
+
+
+class BingSearchClient:
+    """Thread-safe client for the Bing Web Search API, returning results in the format of
+    langchain's `BingSearchAPIWrapper.results`.
+
+    Requests go through a pooled session and a shared token bucket (`requests_per_second`).
+    Rate-limited (429) and server (5xx) responses are retried with exponential backoff, and
+    a `Retry-After` header pauses every worker until the server accepts requests again.
+    """
+    def __init__(self, subscription_key, search_url, requests_per_second=3.0, max_workers=8, max_time=600):
+        self.subscription_key = subscription_key
+        self.search_url = search_url
+        self.bucket = TokenBucket(requests_per_second)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.results = backoff.on_exception(
+            backoff.expo,
+            (RetryableSearchError, requests.ConnectionError, requests.Timeout),
+            max_time=max_time,
+            on_backoff=backoff_hdlr,
+        )(self._results)
+
+    def _results(self, query, count):
+        self.bucket.acquire()
+        response = self.session.get(
+            self.search_url,
+            headers={"Ocp-Apim-Subscription-Key": self.subscription_key},
+            params={"q": query, "count": count, "textDecorations": True, "textFormat": "HTML"},
+            timeout=30,
+        )
+
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = parse_duration(response.headers.get("Retry-After"))
+            if retry_after:
+                self.bucket.update(0, retry_after)
+            raise RetryableSearchError(f"{response.status_code}: {response.text[:200]}")
+        response.raise_for_status()
+
+        search_results = response.json()
+        if "webPages" not in search_results:
+            return [{"Result": "No good Bing Search Result was found"}]
+
+        return [
+            {"snippet": result["snippet"], "title": result["name"], "link": result["url"]}
+            for result in search_results["webPages"]["value"]
+        ]
+
+    def close(self):
+        self.session.close()
+
+
+def load_search_journal(path):
+    """Reads the question id -> results entries of an append-only JSONL journal, skipping a truncated last line."""
+    id2doc = {}
+    if not os.path.exists(path):
+        return id2doc
+
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            id2doc[entry['id']] = entry['results']
+
+    return id2doc
 
-from langchain.utilities import BingSearchAPIWrapper
 
 def main():
     parser = argparse.ArgumentParser()
@@ -12,42 +98,60 @@ def main():
     parser.add_argument("--data_dir", default="", type=str, required=True, help="The input data dir. Should contain the .json files for the task.")
     parser.add_argument("--data_name", default="ASQA.json", type=str, help="The name of the input data file.")
     parser.add_argument("--top_k", default=50, type=int, help="The number of top-k documents to retrieve.")
-    parser.add_argument("--save_step", default=100, type=int, help="The number of steps to save the output.")
-    parser.add_argument("--time", default=-1, type=float, help="The time to sleep between requests.")
+    parser.add_argument("--n_workers", default=8, type=int, help="The number of concurrent search requests.")
+    parser.add_argument("--requests_per_second", default=3.0, type=float, help="The request rate allowed by the API quota.")
+    parser.add_argument("--search_url", default=None, type=str, help="The search endpoint (defaults to $BING_SEARCH_URL).")
     parser.add_argument("--debug", default=False, action="store_true", help="Whether to run in debug mode.")
     parser.add_argument("--output_dir", default=None, type=str, help="The output directory where the output files will be written.")
-    
+
     args = parser.parse_args()
-    
+
     data = json.load(open(os.path.join(args.data_dir, args.data_name)))
-    
-    search = BingSearchAPIWrapper()
-    
+    questions = [(id, ins['ambiguous_question']) for id, ins in data['dev'].items()]
+    if args.debug:
+        questions = questions[:10]
+
+    search = BingSearchClient(os.environ.get("BING_SUBSCRIPTION_KEY", ""),
+                              args.search_url or os.environ["BING_SEARCH_URL"],
+                              requests_per_second=args.requests_per_second,
+                              max_workers=args.n_workers)
+
     os.makedirs(args.output_dir, exist_ok=True)
-    
-    docs = []
-    for idx, (id, ins) in enumerate(data['dev'].items()):
-        if idx % 10 == 0:
-            print(f"Processing {idx}th data...")
-        
-        question = ins['ambiguous_question']
+
+    # finished questions are appended to the journal, so an interrupted run resumes where it stopped
+    journal_path = os.path.join(args.output_dir, "output.jsonl")
+    id2doc = load_search_journal(journal_path)
+    pending = [(id, question) for id, question in questions if id not in id2doc]
+    if len(pending) < len(questions):
+        print(f"Resuming: {len(questions) - len(pending)} questions already searched.")
+
+    # drop a truncated last line; swapped in atomically, so a crash here keeps the searches already paid for
+    write_jsonl_atomic(journal_path, [{'id': id, 'results': doc} for id, doc in id2doc.items()])
+    f_journal = open(journal_path, 'a')
+    lock = threading.Lock()
+
+    def search_question(id, question):
         prefix = "site:en.wikipedia.org"
         doc = search.results(prefix + " " + question, args.top_k)
-        
-        docs += [doc]
-        
-        if (idx + 1) % args.save_step == 0:
-            with open(os.path.join(args.output_dir, f"output_{str(idx+1)}.json"), 'w') as f:
-                json.dump(docs, f, indent=4)
-            print(f"Saved output_{idx}.json!")
-            if args.debug: break
-        
-        if args.time > 0:
-            time.sleep(args.time)
-    
+        with lock:
+            f_journal.write(json.dumps({'id': id, 'results': doc}) + "\n")
+            f_journal.flush()
+            id2doc[id] = doc
+
+    with ThreadPoolExecutor(max_workers=args.n_workers) as executor:
+        futures = [executor.submit(search_question, id, question) for id, question in pending]
+        for idx, future in enumerate(futures):
+            future.result()
+            if (idx + 1) % 100 == 0:
+                print(f"Processed {idx + 1} questions...")
+
+    f_journal.close()
+    search.close()
+
+    docs = [id2doc[id] for id, _ in questions]
     with open(os.path.join(args.output_dir, f"output.json"), 'w') as f:
         json.dump(docs, f, indent=4)
-        
-        
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,7 +1,11 @@
 from .cache_utils import *
 from .gpt3 import *
 from .hf import HFModel
+from .hf_client import HFModelClient
 from .colbertv2 import ColBERTv2
+from .faiss_rm import FaissRM, load_collection
 from .sentence_vectorizer import *
+from .embedding_store import EmbeddingStore
 from .cohere import *
-from .sbert import *
\ No newline at end of file
+from .sbert import *
+from .cascade_reranker import *
\ No newline at end of file
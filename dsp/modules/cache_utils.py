@@ -1,10 +1,19 @@
 import os
+import sys
+import time
+import pickle
+import threading
 
 from pathlib import Path
+from collections import OrderedDict
+import joblib
 from joblib import Memory
+from joblib.memory import MemorizedFunc
+from joblib.func_inspect import filter_args
 from functools import wraps
 
 from dsp.utils import dotdict
+from dsp.modules.sqlite_cache import SQLiteMemory
 
 
 cache_turn_on = True
@@ -17,15 +26,142 @@ def noop_decorator(func):
     return wrapper
 
 
+class MemoryCache:
+    """In-process LRU cache with a memory budget and optional TTL, shared by all functions it decorates.
+
+    Args:
+        max_bytes (int): budget for the (pickled) size of cached values. 0 disables caching.
+        ttl (float, optional): seconds after which an entry expires. Defaults to None (no expiry).
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, n_bytes, expires_at)
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cache(self, func):
+        namespace = f"{func.__module__}.{func.__qualname__}"
+
+        def get_key(args, kwargs):
+            key = (namespace, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                return None
+            return key
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = get_key(args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+
+            found, value = self.get(key)
+            if found:
+                return value
+
+            value = func(*args, **kwargs)
+            self.set(key, value)
+            return value
+
+        def lookup(*args, **kwargs):
+            """(found, value) of the in-memory entry for this call, without calling `func` on a miss."""
+            key = get_key(args, kwargs)
+            if key is None:
+                return False, None
+            # a miss is counted by the call that follows it
+            return self.get(key, count_miss=False)
+
+        wrapper.cache_info = self.cache_info
+        wrapper.lookup = lookup
+        return wrapper
+
+    def get(self, key, count_miss=True):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                if count_miss:
+                    self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def set(self, key, value):
+        if self.max_bytes <= 0:
+            return
+
+        try:
+            n_bytes = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            n_bytes = sys.getsizeof(value)
+        if n_bytes > self.max_bytes:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, n_bytes, expires_at)
+            self.n_bytes += n_bytes
+
+            while self.n_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, n_bytes, _ = self.entries.pop(key)
+        self.n_bytes -= n_bytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def cache_info(self):
+        return dotdict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                       size=len(self.entries), n_bytes=self.n_bytes, max_bytes=self.max_bytes)
+
+
+SQLITE_SUFFIXES = ('.sqlite', '.sqlite3', '.db')
+
+
+def get_cache_memory(location):
+    """A joblib `Memory` for a directory, or a single-file `SQLiteMemory` for a `.sqlite`/`.db` path."""
+    if location.endswith(SQLITE_SUFFIXES):
+        return SQLiteMemory(location)
+    return Memory(location=location, verbose=0)
+
+
 cachedir = os.environ.get('DSP_CACHEDIR') or os.path.join(Path.home(), 'cachedir_joblib')
-CacheMemory = Memory(location=cachedir, verbose=0)
+CacheMemory = get_cache_memory(cachedir)
+if cachedir.endswith(SQLITE_SUFFIXES):
+    # keep other on-disk artifacts (e.g. the embedding store) next to the cache file
+    cachedir = os.path.splitext(cachedir)[0]
 
 cachedir2 = os.environ.get('DSP_NOTEBOOK_CACHEDIR')
 NotebookCacheMemory = dotdict()
 NotebookCacheMemory.cache = noop_decorator
 
 if cachedir2:
-    NotebookCacheMemory = Memory(location=cachedir2, verbose=0)
+    NotebookCacheMemory = get_cache_memory(cachedir2)
+
+
+# in-process layer on top of the disk caches, e.g. DSP_MEMORY_CACHE_MB=512 DSP_MEMORY_CACHE_TTL=3600
+memory_cache_mb = float(os.environ.get('DSP_MEMORY_CACHE_MB', 512))
+memory_cache_ttl = float(os.environ['DSP_MEMORY_CACHE_TTL']) if os.environ.get('DSP_MEMORY_CACHE_TTL') else None
+InMemoryCache = MemoryCache(max_bytes=int(memory_cache_mb * 1024 * 1024) if cache_turn_on else 0,
+                            ttl=memory_cache_ttl)
 
 
 if not cache_turn_on:
@@ -34,3 +170,67 @@ if not cache_turn_on:
 
     NotebookCacheMemory = dotdict()
     NotebookCacheMemory.cache = noop_decorator
+
+
+def is_cached(cached_func, *args, **kwargs) -> bool:
+    """Returns True if `cached_func` (decorated with `CacheMemory.cache`) already stored this call."""
+    if not hasattr(cached_func, 'check_call_in_cache'):
+        return False
+
+    return cached_func.check_call_in_cache(*args, **kwargs)
+
+
+def cache_output(cached_func, output, *args, **kwargs):
+    """Stores `output` as the result of calling `cached_func(*args, **kwargs)`.
+
+    Used by code paths that fetch a result without going through the cached function itself
+    (e.g. async or batched requests), so later synchronous calls still hit the cache.
+    """
+    if hasattr(cached_func, 'store'):
+        cached_func.store(output, *args, **kwargs)
+        return
+
+    if not isinstance(cached_func, MemorizedFunc):
+        return
+
+    # joblib has no public API for this; mirror what MemorizedFunc does around a call
+    # (record the function code first, so the stored output is not treated as stale, and write
+    # metadata.json next to output.pkl as `_persist_input` does, so the entry looks like any other)
+    check_joblib_internals(cached_func)
+    start_time = time.time()
+    cached_func._check_previous_func_code(stacklevel=3)
+    call_id = get_joblib_call_id(cached_func, *args, **kwargs)
+    cached_func.store_backend.dump_item(call_id, output, verbose=0)
+
+    argument_dict = filter_args(cached_func.func, cached_func.ignore, args, kwargs)
+    metadata = {
+        "duration": time.time() - start_time,
+        "input_args": {name: repr(value) for name, value in argument_dict.items()},
+        "time": start_time,
+    }
+    cached_func.store_backend.store_metadata(call_id, metadata)
+
+
+def get_joblib_call_id(cached_func, *args, **kwargs):
+    # joblib < 1.3 computes both identifiers in one method; later versions expose `func_id` and `_get_args_id`
+    if hasattr(cached_func, '_get_output_identifiers'):
+        return list(cached_func._get_output_identifiers(*args, **kwargs))
+    return [cached_func.func_id, cached_func._get_args_id(*args, **kwargs)]
+
+
+JOBLIB_FUNC_INTERNALS = ('func', 'ignore', 'store_backend', '_check_previous_func_code')
+JOBLIB_BACKEND_INTERNALS = ('dump_item', 'store_metadata')
+
+
+def check_joblib_internals(cached_func):
+    """Fails loudly if the joblib internals `cache_output` relies on are gone, instead of caching nothing."""
+    missing = [name for name in JOBLIB_FUNC_INTERNALS if not hasattr(cached_func, name)]
+    if not hasattr(cached_func, '_get_output_identifiers') and \
+            not (hasattr(cached_func, 'func_id') and hasattr(cached_func, '_get_args_id')):
+        missing += ['_get_output_identifiers or func_id/_get_args_id']
+    if not missing:
+        missing = [f"store_backend.{name}" for name in JOBLIB_BACKEND_INTERNALS
+                   if not hasattr(cached_func.store_backend, name)]
+    if missing:
+        raise RuntimeError(f"cache_output does not support joblib {joblib.__version__}: "
+                           f"MemorizedFunc has no {', '.join(missing)}")
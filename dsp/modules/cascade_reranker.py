@@ -0,0 +1,92 @@
+import re
+import math
+import functools
+from collections import Counter
+
+
+@functools.lru_cache(maxsize=100_000)
+def _bm25_tokenize(text: str) -> Counter:
+    return Counter(re.findall(r"\w+", text.lower()))
+
+
+class BM25Scorer:
+    """BM25 over the candidate passages themselves (document frequencies come from the candidate set),
+    so it needs no prebuilt index and can be used as a cheap first-stage reranker.
+    """
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+    def __call__(self, query: str, passages: list[str]) -> list[float]:
+        if len(passages) == 0:
+            return []
+
+        psgs_tfs = [_bm25_tokenize(passage) for passage in passages]
+        psgs_lens = [sum(tfs.values()) for tfs in psgs_tfs]
+        avg_len = max(sum(psgs_lens) / len(passages), 1.0)
+
+        scores = [0.0] * len(passages)
+        for term in set(_bm25_tokenize(query)):
+            df = sum(1 for tfs in psgs_tfs if term in tfs)
+            if df == 0:
+                continue
+            idf = math.log(1 + (len(passages) - df + 0.5) / (df + 0.5))
+            for idx, (tfs, psg_len) in enumerate(zip(psgs_tfs, psgs_lens)):
+                tf = tfs.get(term, 0)
+                if tf:
+                    norm = self.k1 * (1 - self.b + self.b * psg_len / avg_len)
+                    scores[idx] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return scores
+
+
+class CascadeReranker:
+    """Two-stage reranker: a cheap scorer (BM25 by default) prunes the candidates, and the
+    expensive reranker (e.g. `SentenceTransformersCrossEncoder`) only scores the top `top_m` of them.
+
+    Pruned passages are scored below every survivor, in first-stage order, so the output can be
+    used anywhere a reranker's scores are expected (e.g. as `dsp.settings.reranker`).
+    """
+    def __init__(self, reranker, first_stage=None, top_m: int = 20):
+        self.reranker = reranker
+        self.first_stage = first_stage if first_stage is not None else BM25Scorer()
+        self.top_m = top_m
+
+    def __call__(self, query: str, passages: list[str]) -> list[float]:
+        return self.score_pairs([[query, passage] for passage in passages])
+
+    def score_pairs(self, pairs: list[list[str]]) -> list[float]:
+        """Prunes the candidates of each query separately, then scores all survivors in one reranker call."""
+        query2idxs = {}
+        for idx, (query, _) in enumerate(pairs):
+            query2idxs.setdefault(query, []).append(idx)
+
+        lst_survivors = []
+        pruned = []
+        for query, idxs in query2idxs.items():
+            if len(idxs) <= self.top_m:
+                lst_survivors += [idxs]
+                continue
+            first_scores = self.first_stage(query, [pairs[idx][1] for idx in idxs])
+            ranked = [idxs[i] for i in sorted(range(len(idxs)), key=lambda i: -first_scores[i])]
+            lst_survivors += [ranked[:self.top_m]]
+            pruned += [ranked[self.top_m:]]
+
+        survivors = [idx for idxs in lst_survivors for idx in idxs]
+        if hasattr(self.reranker, "score_pairs"):
+            survivor_scores = self.reranker.score_pairs([pairs[idx] for idx in survivors])
+        else:
+            survivor_scores = []
+            for idxs in lst_survivors:
+                survivor_scores += self.reranker(pairs[idxs[0]][0], [pairs[idx][1] for idx in idxs])
+
+        scores = [0.0] * len(pairs)
+        for idx, score in zip(survivors, survivor_scores):
+            scores[idx] = score
+
+        floor = min(survivor_scores, default=0.0) - 1.0
+        for ranked_rest in pruned:
+            for rank, idx in enumerate(ranked_rest):
+                scores[idx] = floor - rank
+
+        return scores
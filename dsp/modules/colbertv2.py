@@ -1,8 +1,9 @@
-import functools
 from typing import Optional, Union, Any
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import requests.adapters
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory
+from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, InMemoryCache, is_cached, cache_output
 from dsp.utils import dotdict
 
 
@@ -10,46 +11,135 @@ from dsp.utils import dotdict
 
 
 class ColBERTv2:
-    """Wrapper for the ColBERTv2 Retrieval."""
+    """Wrapper for the ColBERTv2 Retrieval.
+
+    Requests go through one pooled `requests.Session`. `batch` sends the uncached queries
+    concurrently (or as one multi-query POST when `multi_query` is set and the server supports it)
+    and shares cache entries with single-query calls.
+    """
 
     def __init__(
         self,
         url: str = "http://0.0.0.0",
         port: Optional[Union[str, int]] = None,
         post_requests: bool = False,
+        max_workers: int = 16,
+        multi_query: bool = False,
     ):
         self.post_requests = post_requests
         self.url = f"{url}:{port}" if port else url
+        self.max_workers = max_workers
+        self.multi_query = multi_query
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def __call__(
         self, query: str, k: int = 10, simplify: bool = False
     ) -> Union[list[str], list[dotdict]]:
+        return self.batch([query], k=k, simplify=simplify)[0]
+
+    def batch(
+        self, queries: list[str], k: int = 10, simplify: bool = False
+    ) -> Union[list[list[str]], list[list[dotdict]]]:
         if self.post_requests:
-            topk: list[dict[str, Any]] = colbertv2_post_request(self.url, query, k)
+            cached_request, cached_request_wrapped = colbertv2_post_request_v2, colbertv2_post_request
         else:
-            topk: list[dict[str, Any]] = colbertv2_get_request(self.url, query, k)
+            cached_request, cached_request_wrapped = colbertv2_get_request_v2, colbertv2_get_request
+
+        lst_topk: dict[str, list[dict[str, Any]]] = {}
+        uncached = []
+        for query in queries:
+            if query in lst_topk or query in uncached:
+                continue
+            # the in-memory layer first, so hot queries skip joblib's argument hashing and file lookup
+            found, topk = cached_request_wrapped.lookup(self.url, query, k)
+            if found:
+                lst_topk[query] = topk
+            elif is_cached(cached_request, self.url, query, k):
+                lst_topk[query] = cached_request_wrapped(self.url, query, k)
+            else:
+                uncached.append(query)
+
+        if uncached:
+            for query, topk in zip(uncached, self._fetch(uncached, k)):
+                cache_output(cached_request, topk, self.url, query, k)
+                lst_topk[query] = topk
 
         if simplify:
-            return [psg["long_text"] for psg in topk]
-
-        return [dotdict(psg) for psg in topk]
-
-
-@CacheMemory.cache
-def colbertv2_get_request_v2(url: str, query: str, k: int):
+            return [[psg["long_text"] for psg in lst_topk[query]] for query in queries]
+
+        return [[dotdict(psg) for psg in lst_topk[query]] for query in queries]
+
+    def _fetch(self, queries: list[str], k: int) -> list[list[dict[str, Any]]]:
+        if self.multi_query and len(queries) > 1:
+            try:
+                return colbertv2_multi_query_request(self.session, self.url, queries, k)
+            except (KeyError, ValueError):
+                # the server answered in another format: it does not support multi-query requests
+                self.multi_query = False
+            except requests.HTTPError as e:
+                status_code = e.response.status_code if e.response is not None else None
+                if status_code is not None and 400 <= status_code < 500 and status_code not in (408, 429):
+                    # the server rejects the request format (e.g. 404, 405, 422)
+                    self.multi_query = False
+            except requests.RequestException:
+                # a transient failure (timeout, reset connection); only this call falls back to one request per query
+                pass
+
+        request = colbertv2_post if self.post_requests else colbertv2_get
+        if len(queries) == 1:
+            return [request(self.url, queries[0], k, session=self.session)]
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(queries))) as executor:
+            return list(executor.map(lambda query: request(self.url, query, k, session=self.session), queries))
+
+
+def colbertv2_get(url: str, query: str, k: int, session: Optional[requests.Session] = None):
+    """GET request shared by the cached `colbertv2_get_request_v2` and `ColBERTv2.batch` (over its pooled session)."""
     assert (
         k <= 100
     ), "Only k <= 100 is supported for the hosted ColBERTv2 server at the moment."
 
     payload = {"query": query, "k": k}
-    res = requests.get(url, params=payload, timeout=10)
+    res = (session or requests).get(url, params=payload, timeout=10)
 
     topk = res.json()["topk"][:k]
     topk = [{**d, "long_text": d["text"]} for d in topk]
     return topk[:k]
 
 
-@functools.lru_cache(maxsize=None)
+def colbertv2_post(url: str, query: str, k: int, session: Optional[requests.Session] = None):
+    """POST request shared by the cached `colbertv2_post_request_v2` and `ColBERTv2.batch` (over its pooled session)."""
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    payload = {"query": query, "k": k}
+    res = (session or requests).post(url, json=payload, headers=headers, timeout=10)
+
+    return res.json()["topk"][:k]
+
+
+def colbertv2_multi_query_request(session: requests.Session, url: str, queries: list[str], k: int):
+    """POSTs {"queries": [...], "k": k} and expects {"topk": [[...], ...]} with one list per query."""
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    payload = {"queries": queries, "k": k}
+    res = session.post(url, json=payload, headers=headers, timeout=10 * len(queries))
+    res.raise_for_status()
+
+    lst_topk = res.json()["topk"]
+    if len(lst_topk) != len(queries):
+        raise ValueError("The server returned a different number of results than queries.")
+
+    return [[{**d, "long_text": d.get("long_text", d["text"])} for d in topk[:k]] for topk in lst_topk]
+
+
+@CacheMemory.cache
+def colbertv2_get_request_v2(url: str, query: str, k: int):
+    return colbertv2_get(url, query, k)
+
+
+@InMemoryCache.cache
 @NotebookCacheMemory.cache
 def colbertv2_get_request_v2_wrapped(*args, **kwargs):
     return colbertv2_get_request_v2(*args, **kwargs)
@@ -60,14 +150,10 @@ colbertv2_get_request = colbertv2_get_request_v2_wrapped
 
 @CacheMemory.cache
 def colbertv2_post_request_v2(url: str, query: str, k: int):
-    headers = {"Content-Type": "application/json; charset=utf-8"}
-    payload = {"query": query, "k": k}
-    res = requests.post(url, json=payload, headers=headers, timeout=10)
-
-    return res.json()["topk"][:k]
+    return colbertv2_post(url, query, k)
 
 
-@functools.lru_cache(maxsize=None)
+@InMemoryCache.cache
 @NotebookCacheMemory.cache
 def colbertv2_post_request_v2_wrapped(*args, **kwargs):
     return colbertv2_post_request_v2(*args, **kwargs)
@@ -0,0 +1,72 @@
+import os
+import hashlib
+from typing import List, Optional
+
+import numpy as np
+
+from dsp.modules.cache_utils import cachedir
+
+
+class EmbeddingStore:
+    '''
+    On-disk store for embeddings produced by a vectorizer. Vectors are saved as `.npy` files
+    keyed by the vectorizer model and a content hash of the vectorized texts, and are reloaded
+    memory-mapped, so a warm process start does not re-encode the same collection.
+    '''
+    def __init__(self, location: Optional[str] = None):
+        self.location = location or os.path.join(cachedir, 'embeddings')
+        os.makedirs(self.location, exist_ok=True)
+
+    @staticmethod
+    def get_model_name(vectorizer: "BaseSentenceVectorizer") -> Optional[str]:
+        """Returns an identifier of the embedding model, or None if the vectorizer is not cacheable."""
+        model_name = getattr(vectorizer, 'model_name_or_path', None) or getattr(vectorizer, 'model', None)
+        if not isinstance(model_name, str):
+            return None
+
+        model_name = f"{type(vectorizer).__name__}-{model_name}"
+        if getattr(vectorizer, 'normalize_embeddings', False):
+            model_name += "-normalized"
+        return model_name
+
+    def get_path(self, model_name: str, texts: List[str]) -> str:
+        content_hash = hashlib.sha256()
+        for text in texts:
+            content_hash.update(text.encode('utf-8'))
+            content_hash.update(b'\0')
+
+        model_dir = model_name.replace('/', '__')
+        return os.path.join(self.location, model_dir, f"{content_hash.hexdigest()}.npy")
+
+    def load(self, model_name: str, texts: List[str]) -> Optional[np.ndarray]:
+        path = self.get_path(model_name, texts)
+        if not os.path.exists(path):
+            return None
+
+        # copy-on-write mapping: pages are read lazily and FAISS still gets a writable array
+        return np.load(path, mmap_mode='c')
+
+    def save(self, model_name: str, texts: List[str], embeddings: np.ndarray) -> np.ndarray:
+        path = self.get_path(model_name, texts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so concurrent readers never see a partial array
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+        return np.load(path, mmap_mode='c')
+
+    def vectorize(self, vectorizer: "BaseSentenceVectorizer", inp_examples: List["Example"]) -> np.ndarray:
+        """Returns the embeddings of `inp_examples`, computing and storing them only on a cache miss."""
+        model_name = self.get_model_name(vectorizer)
+        if model_name is None:
+            return vectorizer(inp_examples).astype(np.float32)
+
+        texts = vectorizer._extract_text_from_examples(inp_examples)
+        embeddings = self.load(model_name, texts)
+        if embeddings is None:
+            embeddings = self.save(model_name, texts, vectorizer(inp_examples))
+
+        return embeddings
@@ -0,0 +1,124 @@
+import os
+import csv
+import json
+from typing import Optional, Union
+
+import numpy as np
+
+from dsp.modules.sentence_vectorizer import BaseSentenceVectorizer, SentenceTransformersVectorizer
+from dsp.utils import dotdict
+
+
+def load_collection(path: str) -> list[str]:
+    """Loads passages from a ColBERT-style TSV (`pid \\t text [\\t title]`), a JSONL file with
+    a `text` field per line, or a JSON list of strings."""
+    if path.endswith('.tsv'):
+        collection = []
+        with open(path) as f:
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                text = row[1]
+                if len(row) > 2 and row[2]:
+                    text = f"{row[2]} | {text}"
+                collection.append(text)
+        return collection
+
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            return [json.loads(line)['text'] for line in f if line.strip()]
+
+    with open(path) as f:
+        return json.load(f)
+
+
+class FaissRM:
+    """In-process dense retrieval model with the same `__call__(query, k)` contract as `ColBERTv2`.
+
+    Passages are embedded with `vectorizer` and searched with a FAISS index from `create_faiss_index`.
+    With `embedding_store`, passage vectors are cached on disk and reloaded memory-mapped; with
+    `index_path`, the trained index is saved once and later reopened memory-mapped. Large collections
+    use IVF lists, compressed with PQ when `pq_m` > 0.
+
+    Args:
+        collection (list[str]): the passages to search.
+        vectorizer (BaseSentenceVectorizer, optional): embeds passages and queries.
+            Defaults to a normalized `SentenceTransformersVectorizer`.
+        embedding_store (EmbeddingStore, optional): on-disk store for the passage vectors. Defaults to None.
+        index_path (str, optional): file to save the index to, or load it from if it exists. Defaults to None.
+        dist_type (str, optional): `IP` or `L2`. Defaults to "IP".
+        n_probe (int, optional): number of IVF lists to visit per query. Defaults to 10.
+        pq_m (int, optional): number of PQ sub-quantizers, 0 to disable PQ. Defaults to 0.
+    """
+
+    def __init__(
+        self,
+        collection: list[str],
+        vectorizer: Optional[BaseSentenceVectorizer] = None,
+        embedding_store: Optional["EmbeddingStore"] = None,
+        index_path: Optional[str] = None,
+        dist_type: str = 'IP',
+        n_probe: int = 10,
+        pq_m: int = 0,
+        max_gpu_devices: int = 0,
+    ):
+        from dsp.utils.ann_utils import create_faiss_index, faiss
+
+        self.collection = collection
+        self.vectorizer = vectorizer or SentenceTransformersVectorizer(normalize_embeddings=True)
+        self.dist_type = dist_type
+
+        if index_path is not None and os.path.exists(index_path):
+            try:
+                self.index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                # not every index type can be memory-mapped
+                self.index = faiss.read_index(index_path)
+            self.index.nprobe = n_probe
+            assert self.index.ntotal == len(collection), "The saved index does not match the collection."
+            return
+
+        psgs_to_vectorize = [dotdict(text_to_vectorize=passage) for passage in collection]
+        if embedding_store is not None:
+            vectors = embedding_store.vectorize(self.vectorizer, psgs_to_vectorize)
+        else:
+            vectors = self.vectorizer(psgs_to_vectorize).astype(np.float32)
+
+        self.index = create_faiss_index(
+            emb_dim=vectors.shape[1],
+            n_objects=len(collection),
+            n_probe=n_probe,
+            max_gpu_devices=max_gpu_devices,
+            in_list_dist_type=dist_type,
+            centroid_dist_type=dist_type,
+            pq_m=pq_m,
+        )
+        self.index.train(vectors)
+        self.index.add(vectors)
+
+        if index_path is not None:
+            index = self.index
+            if max_gpu_devices != 0 and hasattr(faiss, 'index_gpu_to_cpu'):
+                index = faiss.index_gpu_to_cpu(index)
+            faiss.write_index(index, index_path)
+
+    def __call__(
+        self, query: str, k: int = 10, simplify: bool = False
+    ) -> Union[list[str], list[dotdict]]:
+        query_vector = self.vectorizer([dotdict(text_to_vectorize=query)]).astype(np.float32)
+        distances, pids = self.index.search(query_vector, k)
+
+        scores = distances[0] if self.dist_type.lower() == 'ip' else -distances[0]
+        pids = pids[0]
+        valid = pids >= 0
+        scores, pids = scores[valid], pids[valid]
+
+        if simplify:
+            return [self.collection[pid] for pid in pids]
+
+        probs = np.exp(scores - scores.max()) if len(scores) else scores
+        probs = probs / probs.sum() if len(scores) else probs
+
+        return [
+            dotdict(pid=int(pid), rank=rank + 1, score=float(score), prob=float(prob),
+                    text=self.collection[pid], long_text=self.collection[pid])
+            for rank, (pid, score, prob) in enumerate(zip(pids, scores, probs))
+        ]
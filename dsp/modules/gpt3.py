@@ -1,14 +1,18 @@
-import functools
+import asyncio
 import json
 from typing import Any, Literal, Optional, cast
 
+import aiohttp
 import backoff
 import openai
 import openai.error
+import openai.util
 from openai.openai_object import OpenAIObject
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
+from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, InMemoryCache, is_cached, cache_output
 from dsp.modules.lm import LM
+from dsp.utils.rate_limit import TokenBucket, parse_duration
+from dsp.utils.aio_session import AioSessionPool
 
 
 def backoff_hdlr(details):
@@ -28,6 +32,9 @@ class GPT3(LM):
         api_key (Optional[str], optional): API provider Authentication token. use Defaults to None.
         api_provider (Literal["openai", "azure"], optional): The API provider to use. Defaults to "openai".
         model_type (Literal["chat", "text"], optional): The type of model that was specified. Mainly to decide the optimal prompting strategy. Defaults to "text".
+        max_concurrent_requests (int, optional): Maximum number of in-flight requests of the async path (`acall`). Defaults to 16.
+        requests_per_minute (Optional[int], optional): Request quota for the async path. Learned from the rate-limit response headers if not given. Defaults to None.
+        tokens_per_minute (Optional[int], optional): Token quota for the async path. Learned from the rate-limit response headers if not given. Defaults to None.
         **kwargs: Additional arguments to pass to the API provider.
     """
 
@@ -37,11 +44,18 @@ class GPT3(LM):
         api_key: Optional[str] = None,
         api_provider: Literal["openai", "azure"] = "openai",
         model_type: Literal["chat", "text"] = "text",
+        max_concurrent_requests: int = 16,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
         **kwargs,
     ):
         super().__init__(model)
         self.provider = "openai"
         self.model_type = model_type
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_bucket = TokenBucket(requests_per_minute / 60.0, requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) if tokens_per_minute else None
+        self.aio_sessions = AioSessionPool(max_concurrent_requests)
 
         if api_provider == "azure":
             assert (
@@ -109,6 +123,122 @@ class GPT3(LM):
         
         return self.basic_request(prompt, **kwargs)
 
+    async def abasic_request(self, prompt: str, **kwargs) -> OpenAIObject:
+        raw_kwargs = kwargs
+
+        kwargs = {**self.kwargs, **kwargs}
+        if self.model_type == "chat":
+            kwargs["messages"] = [{"role": "user", "content": prompt}]
+            kwargs = {
+                "stringify_request": json.dumps(kwargs)
+            }
+            cached_request, cached_request_wrapped = _cached_gpt3_turbo_request_v2, cached_gpt3_turbo_request
+        else:
+            kwargs["prompt"] = prompt
+            cached_request, cached_request_wrapped = cached_gpt3_request_v2, cached_gpt3_request
+
+        if is_cached(cached_request, **kwargs):
+            response = await asyncio.to_thread(cached_request_wrapped, **kwargs)
+        else:
+            response = await self._apost(**kwargs)
+            cache_output(cached_request, response, **kwargs)
+
+        history = {
+            "prompt": prompt,
+            "response": response,
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        }
+        self.history.append(history)
+
+        return response
+
+    @backoff.on_exception(
+        backoff.expo,
+        (openai.error.RateLimitError, openai.error.ServiceUnavailableError, aiohttp.ClientConnectionError),
+        max_time=1000,
+        on_backoff=backoff_hdlr,
+    )
+    async def arequest(self, prompt: str, **kwargs) -> OpenAIObject:
+        """Async version of `request`, sharing its cache entries."""
+        if "model_type" in kwargs:
+            del kwargs["model_type"]
+
+        return await self.abasic_request(prompt, **kwargs)
+
+    async def aclose(self):
+        """Closes the HTTP sessions used by the async path."""
+        await self.aio_sessions.aclose()
+
+    def _get_api_request(self, kwargs: dict[str, Any]) -> tuple[str, dict[str, str], dict[str, Any]]:
+        endpoint = "chat/completions" if "messages" in kwargs else "completions"
+        api_base = kwargs.get("api_base") or openai.api_base
+        payload = {
+            k: v for k, v in kwargs.items()
+            if k not in ("api_base", "api_version", "api_key", "api_type", "engine", "deployment_id", "organization")
+        }
+
+        if openai.api_type == "azure":
+            deployment_id = kwargs.get("deployment_id") or kwargs.get("engine")
+            api_version = kwargs.get("api_version") or openai.api_version
+            url = f"{api_base.rstrip('/')}/openai/deployments/{deployment_id}/{endpoint}?api-version={api_version}"
+            headers = {"api-key": openai.api_key}
+        else:
+            url = f"{api_base.rstrip('/')}/{endpoint}"
+            headers = {"Authorization": f"Bearer {openai.api_key}"}
+            if openai.organization:
+                headers["OpenAI-Organization"] = openai.organization
+
+        return url, headers, payload
+
+    def _update_rate_limits(self, headers):
+        for kind in ("requests", "tokens"):
+            limit = headers.get(f"x-ratelimit-limit-{kind}")
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if limit is None or remaining is None:
+                continue
+
+            bucket_name = "request_bucket" if kind == "requests" else "token_bucket"
+            if getattr(self, bucket_name) is None:
+                setattr(self, bucket_name, TokenBucket(float(limit) / 60.0, float(limit)))
+            getattr(self, bucket_name).update(
+                float(remaining), parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            )
+
+    async def _apost(self, **kwargs) -> OpenAIObject:
+        if "stringify_request" in kwargs:
+            kwargs = json.loads(kwargs["stringify_request"])
+        url, headers, payload = self._get_api_request(kwargs)
+
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire_async()
+        if self.token_bucket is not None:
+            # rough estimate of prompt tokens plus the completion budget
+            prompt_text = payload.get("prompt") or json.dumps(payload.get("messages", ""))
+            n_tokens = len(prompt_text) / 4 + payload.get("max_tokens", 0) * payload.get("n", 1)
+            await self.token_bucket.acquire_async(min(n_tokens, self.token_bucket.capacity))
+
+        session, semaphore = self.aio_sessions.get()
+        async with semaphore:
+            async with session.post(url, json=payload, headers=headers) as res:
+                self._update_rate_limits(res.headers)
+                body = await res.json(content_type=None)
+
+        if res.status == 429:
+            raise openai.error.RateLimitError(
+                str(body), json_body=body, http_status=res.status, headers=dict(res.headers)
+            )
+        if res.status >= 500:
+            raise openai.error.ServiceUnavailableError(
+                str(body), json_body=body, http_status=res.status, headers=dict(res.headers)
+            )
+        if res.status != 200:
+            raise openai.error.APIError(
+                str(body), json_body=body, http_status=res.status, headers=dict(res.headers)
+            )
+
+        return openai.util.convert_to_openai_object(body)
+
     def _get_choice_text(self, choice: dict[str, Any]) -> str:
         if self.model_type == "chat":
             return choice["message"]["content"]
@@ -142,6 +272,39 @@ class GPT3(LM):
                 kwargs = {**kwargs, "logprobs": 5}
 
         response = self.request(prompt, **kwargs)
+
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    async def acall(
+        self,
+        prompt: str,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[dict[str, Any]]:
+        """Async version of `__call__`. Requests share one HTTP connection pool and are bounded
+        by `max_concurrent_requests` and the rate limits reported by the API."""
+
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        if kwargs.get("n", 1) > 1:
+            if self.model_type == "chat":
+                kwargs = {**kwargs}
+            else:
+                kwargs = {**kwargs, "logprobs": 5}
+
+        response = await self.arequest(prompt, **kwargs)
+
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    def _get_completions(
+        self,
+        response: OpenAIObject,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[dict[str, Any]]:
         choices = response["choices"]
 
         completed_choices = [c for c in choices if c["finish_reason"] != "length"]
@@ -178,7 +341,7 @@ def cached_gpt3_request_v2(**kwargs):
     return openai.Completion.create(**kwargs)
 
 
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
+@InMemoryCache.cache
 @NotebookCacheMemory.cache
 def cached_gpt3_request_v2_wrapped(**kwargs):
     return cached_gpt3_request_v2(**kwargs)
@@ -194,7 +357,7 @@ def _cached_gpt3_turbo_request_v2(**kwargs) -> OpenAIObject:
     return cast(OpenAIObject, openai.ChatCompletion.create(**kwargs))
 
 
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
+@InMemoryCache.cache
 @NotebookCacheMemory.cache
 def _cached_gpt3_turbo_request_v2_wrapped(**kwargs) -> OpenAIObject:
     return _cached_gpt3_turbo_request_v2(**kwargs)
@@ -1,3 +1,7 @@
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
 from typing import Optional, Literal
 from dsp.modules.lm import LM
 
@@ -21,9 +25,114 @@ def openai_to_hf(**kwargs):
     return hf_kwargs
 
 
+def get_micro_batches(lengths, max_batch_tokens, n_seqs=1, new_tokens=0):
+    """Groups prompt indices by length into batches whose padded size fits `max_batch_tokens`,
+    with `n_seqs` sequences generated per prompt. A prompt longer than the budget still gets a batch of its own.
+    """
+    micro_batches = []
+    micro_batch = []
+    for idx in sorted(range(len(lengths)), key=lambda idx: lengths[idx]):
+        # in ascending order, the new prompt is the longest and sets the padded length
+        n_tokens = (len(micro_batch) + 1) * n_seqs * (lengths[idx] + new_tokens)
+        if micro_batch and n_tokens > max_batch_tokens:
+            micro_batches.append(micro_batch)
+            micro_batch = []
+        micro_batch.append(idx)
+
+    if micro_batch:
+        micro_batches.append(micro_batch)
+
+    return micro_batches
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _from_legacy_cache(past_key_values):
+    """Wraps cached tensors in a fresh cache object (newer transformers), so generation never
+    extends the tensors held by `PrefixCache` in place."""
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past_key_values
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+def _slice_past(past_key_values, n_tokens, copy=False):
+    sliced = tuple((key[:, :, :n_tokens], value[:, :, :n_tokens]) for key, value in past_key_values)
+    if copy: # a view would keep the whole original tensors alive
+        sliced = tuple((key.contiguous(), value.contiguous()) for key, value in sliced)
+    return sliced
+
+
+class PrefixCache:
+    """Bounded LRU of past_key_values for prompt prefixes of causal models.
+
+    Prefixes are identified at multiples of `block_size` tokens by a running hash of the token ids.
+    Each entry holds the keys/values of one prompt and is indexed under all of its block hashes,
+    so a later prompt that shares only its first blocks (e.g. the instructions but not the demos)
+    reuses a slice of it.
+    """
+    def __init__(self, max_entries=8, block_size=64):
+        self.max_entries = max_entries
+        self.block_size = block_size
+        self.entries = OrderedDict()  # entry id -> (past_key_values, block keys)
+        self.index = {}  # block key -> entry id
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def get_block_keys(self, input_ids, n_tokens):
+        """Hashes of the first k * block_size tokens, for every full block within `n_tokens`."""
+        ids = [int(token_id) for token_id in input_ids[:n_tokens]]
+        sha = hashlib.sha1()
+        keys = []
+        for start in range(0, n_tokens - self.block_size + 1, self.block_size):
+            sha.update(str(ids[start:start + self.block_size]).encode())
+            keys.append(sha.digest())
+        return keys
+
+    def lookup(self, block_keys):
+        """Returns the number of cached prefix tokens and their past_key_values (None on a miss)."""
+        with self.lock:
+            for n_blocks in range(len(block_keys), 0, -1):
+                entry_id = self.index.get(block_keys[n_blocks - 1])
+                if entry_id in self.entries:
+                    self.entries.move_to_end(entry_id)
+                    n_tokens = n_blocks * self.block_size
+                    self.hits += 1
+                    self.reused_tokens += n_tokens
+                    return n_tokens, _slice_past(self.entries[entry_id][0], n_tokens)
+            self.misses += 1
+        return 0, None
+
+    def add(self, block_keys, past_key_values):
+        past_key_values = _slice_past(past_key_values, len(block_keys) * self.block_size, copy=True)
+        with self.lock:
+            entry_id = next(self.ids)
+            self.entries[entry_id] = (past_key_values, block_keys)
+            for key in block_keys:
+                self.index[key] = entry_id
+
+            while len(self.entries) > self.max_entries:
+                old_id, (_, old_keys) = self.entries.popitem(last=False)
+                for key in old_keys:
+                    if self.index.get(key) == old_id:
+                        del self.index[key]
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "reused_tokens": self.reused_tokens, "size": len(self.entries)}
+
+
 class HFModel(LM):
     def __init__(self, model: str, checkpoint: Optional[str] = None, is_client: bool = False,
-                 hf_device_map: Literal["auto", "balanced", "balanced_low_0", "sequential"] = "auto"):
+                 hf_device_map: Literal["auto", "balanced", "balanced_low_0", "sequential"] = "auto",
+                 max_batch_tokens: int = 8192, prefix_cache_size: int = 0, prefix_block_size: int = 64):
         """wrapper for Hugging Face models
 
         Args:
@@ -32,6 +141,10 @@ class HFModel(LM):
             is_client (bool, optional): whether to access models via client. Defaults to False.
             hf_device_map (str, optional): HF config strategy to load the model. 
                 Recommeded to use "auto", which will help loading large models using accelerate. Defaults to "auto".
+            max_batch_tokens (int, optional): budget of padded prompt plus new tokens per micro-batch in `batch_generate`. Defaults to 8192.
+            prefix_cache_size (int, optional): number of prompt prefixes whose past_key_values are kept for reuse
+                by causal models (see `PrefixCache`), 0 to disable. Defaults to 0.
+            prefix_block_size (int, optional): granularity in tokens at which prefixes are matched. Defaults to 64.
         """
         try:
             from transformers import AutoModelForSeq2SeqLM, AutoModelForCausalLM, AutoTokenizer
@@ -45,6 +158,7 @@ class HFModel(LM):
         self.is_client = is_client
         self.device_map = hf_device_map
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.max_batch_tokens = max_batch_tokens
         if not self.is_client:
             try:
                 self.model = AutoModelForSeq2SeqLM.from_pretrained(
@@ -59,6 +173,13 @@ class HFModel(LM):
                 )
                 self.drop_prompt_from_output = True
             self.tokenizer = AutoTokenizer.from_pretrained(model)
+            # batched prompts are left-padded, so every generation continues right after its prompt
+            self.tokenizer.padding_side = "left"
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.prefix_cache = None
+        if not self.is_client and self.drop_prompt_from_output and prefix_cache_size > 0:
+            self.prefix_cache = PrefixCache(prefix_cache_size, prefix_block_size)
         self.history = []
 
     def basic_request(self, prompt, **kwargs):
@@ -81,7 +202,10 @@ class HFModel(LM):
         # TODO: Add caching
         kwargs = {**openai_to_hf(**self.kwargs), **openai_to_hf(**kwargs)}
         inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-        outputs = self.model.generate(**inputs, **kwargs)
+        if self._can_reuse_prefix(kwargs):
+            outputs = self._generate_with_prefix_cache(inputs.input_ids, **kwargs)
+        else:
+            outputs = self.model.generate(**inputs, **kwargs)
         if self.drop_prompt_from_output:
             input_length = inputs.input_ids.shape[1]
             outputs = outputs[:, input_length:]
@@ -95,6 +219,113 @@ class HFModel(LM):
         }
         return response
 
+    def _can_reuse_prefix(self, kwargs):
+        # beams and multiple sequences would need the cached past expanded per sequence
+        return self.prefix_cache is not None and \
+            kwargs.get("num_beams", 1) == 1 and kwargs.get("num_return_sequences", 1) == 1
+
+    def _generate_with_prefix_cache(self, input_ids, **kwargs):
+        """Generates from a single sequence, reusing the past_key_values of its longest cached prefix.
+
+        The uncached part of the prompt, except its last token, is encoded with explicit forward passes,
+        and `generate` continues from a past that covers all but the last prompt token. Transformers
+        versions that only feed the last token when a past is given therefore behave the same as newer ones.
+        """
+        import torch
+
+        n_prefix = input_ids.shape[1] - 1
+        block_keys = self.prefix_cache.get_block_keys(input_ids[0].tolist(), n_prefix)
+        n_cached, past_key_values = self.prefix_cache.lookup(block_keys)
+
+        with torch.no_grad():
+            if n_cached < n_prefix:
+                outputs = self.model(
+                    input_ids=input_ids[:, n_cached:n_prefix],
+                    past_key_values=_from_legacy_cache(past_key_values) if past_key_values is not None else None,
+                    use_cache=True,
+                )
+                past_key_values = _to_legacy_cache(outputs.past_key_values)
+
+        if len(block_keys) * self.prefix_cache.block_size > n_cached:
+            self.prefix_cache.add(block_keys, past_key_values)
+
+        if n_prefix == 0:
+            return self.model.generate(input_ids=input_ids, **kwargs)
+
+        return self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=_from_legacy_cache(past_key_values),
+            **kwargs,
+        )
+
+    def batch_request(self, prompts, **kwargs):
+        raw_kwargs = kwargs
+        kwargs = {**self.kwargs, **kwargs}
+        responses = self.batch_generate(prompts, **kwargs)
+
+        for prompt, response in zip(prompts, responses):
+            history = {
+                "prompt": prompt,
+                "response": response,
+                "kwargs": kwargs,
+                "raw_kwargs": raw_kwargs,
+            }
+            self.history.append(history)
+
+        return responses
+
+    def batch_generate(self, prompts, max_batch_tokens=None, **kwargs):
+        """Generates completions for several prompts with shared forward passes.
+
+        Prompts are sorted by length and split into left-padded micro-batches of at most
+        `max_batch_tokens` (padded prompt plus new tokens, per beam or returned sequence), so prompts of
+        similar length run together with little padding. Returns one `_generate` response per prompt.
+        """
+        assert not self.is_client
+        kwargs = {**openai_to_hf(**self.kwargs), **openai_to_hf(**kwargs)}
+        max_batch_tokens = max_batch_tokens or self.max_batch_tokens
+        n_seqs = kwargs.get("num_return_sequences", 1)
+        # beam search runs num_beams sequences per prompt, however few of them are returned
+        n_running_seqs = max(kwargs.get("num_beams", 1), n_seqs)
+        
+        lengths = [len(input_ids) for input_ids in self.tokenizer(prompts).input_ids]
+        micro_batches = get_micro_batches(lengths, max_batch_tokens, 
+                                          n_seqs=n_running_seqs, new_tokens=kwargs.get("max_new_tokens", 0))
+
+        responses = [None] * len(prompts)
+        for micro_batch in micro_batches:
+            inputs = self.tokenizer([prompts[idx] for idx in micro_batch], 
+                                    return_tensors="pt", padding=True).to(self.device)
+            if len(micro_batch) == 1 and self._can_reuse_prefix(kwargs):
+                outputs = self._generate_with_prefix_cache(inputs.input_ids, **kwargs)
+            else:
+                outputs = self.model.generate(**inputs, **kwargs)
+            if self.drop_prompt_from_output:
+                input_length = inputs.input_ids.shape[1]
+                outputs = outputs[:, input_length:]
+            texts = self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+            for i, idx in enumerate(micro_batch):
+                completions = [{"text": c} for c in texts[i * n_seqs:(i + 1) * n_seqs]]
+                responses[idx] = {
+                    "prompt": prompts[idx],
+                    "choices": completions,
+                }
+
+        return responses
+
+    def batch(self, prompts, only_completed=True, return_sorted=False, **kwargs):
+        """Batched counterpart of `__call__`: returns the completions of each prompt."""
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        if kwargs.get("n", 1) > 1:
+            kwargs["num_beams"] = max(5, kwargs["n"])
+
+        responses = self.batch_request(prompts, **kwargs)
+        return [[c["text"] for c in response["choices"]] for response in responses]
+
     def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
         assert only_completed, "for now"
         assert return_sorted is False, "for now"
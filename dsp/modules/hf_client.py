@@ -1,19 +1,189 @@
+import json
+import asyncio
+from typing import Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import backoff
 import requests
+import requests.adapters
+
+from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, InMemoryCache, is_cached, cache_output
+from dsp.modules.lm import LM
+from dsp.utils.aio_session import AioSessionPool
+
+
+class HFServerUnavailableError(Exception):
+    """The server answered 503 (queue full) or another 5xx status."""
+
 
-from dsp.modules.hf import HFModel
+def backoff_hdlr(details):
+    """Handler from https://pypi.org/project/backoff/"""
+    print(
+        "Backing off {wait:0.1f} seconds after {tries} tries "
+        "calling function {target}".format(**details)
+    )
 
 
-class HFModelClient(HFModel):
-    def __init__(self, port, model, url="http://0.0.0.0"):
-        super().__init__(model=model, is_client=True)
+class HFModelClient(LM):
+    """Client for a Hugging Face model served by `hf_server.py`, so several processes can share
+    one copy of the weights. Needs neither torch nor transformers on the client side.
+
+    Requests go through a pooled `requests.Session` (or an aiohttp session for `acall`), are
+    retried with backoff when the server is unreachable or busy, and are cached like `GPT3` requests.
+    Concurrent requests, e.g. from `batch`, are batched together by the server.
+
+    Args:
+        port (int): port of the server.
+        model (str): HF model identifier served by the server, part of the cache key.
+        url (str, optional): server address. Defaults to "http://0.0.0.0".
+        max_concurrent_requests (int, optional): connection pool size and maximum number of
+            in-flight requests of `batch` and `acall`. Defaults to 16.
+        max_time (float, optional): seconds to keep retrying a request. Defaults to 600.
+        **kwargs: default generation arguments (OpenAI-style, e.g. `max_tokens`).
+    """
+
+    def __init__(
+        self,
+        port: int,
+        model: str,
+        url: str = "http://0.0.0.0",
+        max_concurrent_requests: int = 16,
+        max_time: float = 600,
+        **kwargs,
+    ):
+        super().__init__(model)
+        self.provider = "hf"
         self.url = f"{url}:{port}"
+        self.kwargs = {**self.kwargs, **kwargs}
+        self.max_concurrent_requests = max_concurrent_requests
         self.headers = {"Content-Type": "application/json; charset=utf-8"}
 
-    def _generate(self, prompt, **kwargs):
-        payload = {"prompt": prompt, **kwargs}
-        response = requests.post(self.url, json=payload, headers=self.headers)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent_requests)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.aio_sessions = AioSessionPool(max_concurrent_requests)
+
+        self._post = backoff.on_exception(
+            backoff.expo,
+            (HFServerUnavailableError, requests.ConnectionError, requests.Timeout),
+            max_time=max_time,
+            on_backoff=backoff_hdlr,
+        )(self._post)
+        self._apost = backoff.on_exception(
+            backoff.expo,
+            (HFServerUnavailableError, aiohttp.ClientConnectionError, asyncio.TimeoutError),
+            max_time=max_time,
+            on_backoff=backoff_hdlr,
+        )(self._apost)
+
+    def _get_request(self, prompt: str, **kwargs) -> tuple[str, dict[str, Any]]:
+        kwargs = {**self.kwargs, **kwargs}
+        # canonical JSON, so the same request always maps to the same cache entry
+        stringify_request = json.dumps({"prompt": prompt, "kwargs": kwargs}, sort_keys=True)
+        return stringify_request, kwargs
+
+    def basic_request(self, prompt: str, **kwargs) -> dict[str, Any]:
+        raw_kwargs = kwargs
+        stringify_request, kwargs = self._get_request(prompt, **kwargs)
+
+        if is_cached(cached_hf_client_request_v2, self.url, stringify_request):
+            response = cached_hf_client_request(self.url, stringify_request)
+        else:
+            response = self._post(stringify_request)
+            cache_output(cached_hf_client_request_v2, response, self.url, stringify_request)
+
+        self._log(prompt, response, kwargs, raw_kwargs)
+        return response
+
+    async def abasic_request(self, prompt: str, **kwargs) -> dict[str, Any]:
+        raw_kwargs = kwargs
+        stringify_request, kwargs = self._get_request(prompt, **kwargs)
+
+        if is_cached(cached_hf_client_request_v2, self.url, stringify_request):
+            response = await asyncio.to_thread(cached_hf_client_request, self.url, stringify_request)
+        else:
+            response = await self._apost(stringify_request)
+            cache_output(cached_hf_client_request_v2, response, self.url, stringify_request)
+
+        self._log(prompt, response, kwargs, raw_kwargs)
+        return response
+
+    def _log(self, prompt, response, kwargs, raw_kwargs):
+        history = {
+            "prompt": prompt,
+            "response": response,
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        }
+        self.history.append(history)
+
+    def _post(self, stringify_request: str) -> dict[str, Any]:
+        res = self.session.post(self.url, data=stringify_request.encode("utf-8"), headers=self.headers, timeout=600)
+        if res.status_code >= 500:
+            raise HFServerUnavailableError(f"{res.status_code}: {res.text[:200]}")
+        res.raise_for_status()
+
         try:
-            return response.json()
-        except:
-            print("Failed to parse JSON response:", response.text)
+            return res.json()
+        except ValueError:
+            print("Failed to parse JSON response:", res.text)
             raise Exception("Received invalid JSON response from server")
+
+    async def aclose(self):
+        """Closes the HTTP sessions used by the async path."""
+        await self.aio_sessions.aclose()
+
+    async def _apost(self, stringify_request: str) -> dict[str, Any]:
+        session, semaphore = self.aio_sessions.get()
+        async with semaphore:
+            async with session.post(self.url, data=stringify_request.encode("utf-8"), headers=self.headers) as res:
+                if res.status >= 500:
+                    raise HFServerUnavailableError(f"{res.status}: {(await res.text())[:200]}")
+                res.raise_for_status()
+                return await res.json(content_type=None)
+
+    @staticmethod
+    def _get_generation_kwargs(kwargs):
+        if kwargs.get("n", 1) > 1:
+            kwargs = {**kwargs, "num_beams": max(5, kwargs["n"])}
+        return kwargs
+
+    def __call__(self, prompt: str, only_completed: bool = True, return_sorted: bool = False, **kwargs) -> list[str]:
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        response = self.request(prompt, **self._get_generation_kwargs(kwargs))
+        return [c["text"] for c in response["choices"]]
+
+    async def acall(self, prompt: str, only_completed: bool = True, return_sorted: bool = False, **kwargs) -> list[str]:
+        """Async version of `__call__`, sharing its cache entries."""
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        response = await self.abasic_request(prompt, **self._get_generation_kwargs(kwargs))
+        return [c["text"] for c in response["choices"]]
+
+    def batch(self, prompts: list[str], max_workers: Optional[int] = None, **kwargs) -> list[list[str]]:
+        """Sends the prompts concurrently, so the server can run them as one batch."""
+        max_workers = min(max_workers or self.max_concurrent_requests, max(len(prompts), 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(lambda prompt: self(prompt, **kwargs), prompts))
+
+
+@CacheMemory.cache
+def cached_hf_client_request_v2(url: str, stringify_request: str):
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    res = requests.post(url, data=stringify_request.encode("utf-8"), headers=headers, timeout=600)
+    res.raise_for_status()
+    return res.json()
+
+
+@InMemoryCache.cache
+@NotebookCacheMemory.cache
+def cached_hf_client_request_v2_wrapped(*args, **kwargs):
+    return cached_hf_client_request_v2(*args, **kwargs)
+
+
+cached_hf_client_request = cached_hf_client_request_v2_wrapped
@@ -2,25 +2,25 @@
 # python -m dsp.modules.hf_server --port 4242 --model "google/flan-t5-base"
 
 # To Query:
-# curl -d '{"prompt":".."}' -X POST "http://0.0.0.0:4242" -H 'Content-Type: application/json'
-# Or use the HF client. TODO: Add support for kwargs to the server.
+# curl -d '{"prompt":"..", "kwargs": {"max_tokens": 50}}' -X POST "http://0.0.0.0:4242" -H 'Content-Type: application/json'
+# Or use the HF client (dsp.HFModelClient). Serving metrics are at GET /metrics.
 
 
-from functools import lru_cache
 import argparse
+import asyncio
+import json
 import time
-import random
-import os
-import sys
 import uvicorn
 import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from argparse import ArgumentParser
 from starlette.middleware.cors import CORSMiddleware
 
 from dsp.modules.hf import HFModel
+from dsp.modules.cache_utils import MemoryCache
 
 
 class Query(BaseModel):
@@ -28,40 +28,213 @@ class Query(BaseModel):
     kwargs: dict = {}
 
 
-warnings.filterwarnings("ignore")
+class BatchScheduler:
+    """Collects concurrent requests into batches for `HFModel.batch_generate`.
+
+    The first queued request opens a window of `batch_window_ms`; everything that arrives within it
+    (up to `max_batch_size`) runs together, grouped by kwargs, on a single model thread. Identical
+    requests in a batch are generated once. At most `max_queue_size` requests wait, and further ones
+    are rejected so clients back off instead of piling up behind the model.
+    """
+
+    def __init__(self, lm, max_batch_size=16, batch_window_ms=10.0, max_queue_size=256,
+                 cache_bytes=256 * 1024 * 1024, n_latencies=1000):
+        self.lm = lm
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.cache = MemoryCache(cache_bytes)
+        self.executor = ThreadPoolExecutor(max_workers=1)  # the model runs one batch at a time
+
+        self.queue = None
+        self.worker = None
+        self.in_flight = []
+
+        self.started_at = time.time()
+        self.n_requests = 0
+        self.n_rejected = 0
+        self.n_generated = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.latencies = deque(maxlen=n_latencies)
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self.worker = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=False)
+
+        # nothing answers the batch that was running or the requests still queued
+        error = RuntimeError("The server is shutting down")
+        self.fail(self.in_flight, error)
+        while not self.queue.empty():
+            self.fail([self.queue.get_nowait()[-1]], error)
+
+    @staticmethod
+    def fail(futures, error):
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    @staticmethod
+    def get_key(prompt, kwargs):
+        return (prompt, json.dumps(kwargs, sort_keys=True))
+
+    async def submit(self, prompt, kwargs):
+        start = time.time()
+        self.n_requests += 1
+        key = self.get_key(prompt, kwargs)
+
+        found, response = self.cache.get(key)
+        if not found:
+            future = asyncio.get_running_loop().create_future()
+            try:
+                self.queue.put_nowait((key, prompt, kwargs, future))
+            except asyncio.QueueFull:
+                self.n_rejected += 1
+                raise
+            response = await future
+
+        latency = (time.time() - start) * 1000.0
+        self.latencies.append(latency)
+        return {**response, "latency": latency}
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            self.in_flight = [future for _, _, _, future in batch]
+            try:
+                await self.run_batch(batch)
+            except Exception as e:
+                # the worker must outlive any failure, or every later request would hang
+                self.n_errors += 1
+                self.fail(self.in_flight, e)
+            self.in_flight = []
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+
+        # group by kwargs (generation settings must be shared), then deduplicate prompts
+        groups = {}
+        for key, prompt, kwargs, future in batch:
+            group = groups.setdefault(key[1], {"kwargs": kwargs, "prompts": {}})
+            group["prompts"].setdefault(prompt, []).append(future)
+
+        for kwargs_key, group in groups.items():
+            prompts = list(group["prompts"].keys())
+            futures = [future for prompt_futures in group["prompts"].values() for future in prompt_futures]
+            try:
+                responses = await loop.run_in_executor(
+                    self.executor, lambda: self.lm.batch_generate(prompts, **group["kwargs"])
+                )
+                assert len(responses) == len(prompts), \
+                    f"batch_generate returned {len(responses)} responses for {len(prompts)} prompts"
+
+                self.n_batches += 1
+                self.n_generated += len(prompts)
+                for prompt, response in zip(prompts, responses):
+                    self.cache.set((prompt, kwargs_key), response)
+                    for future in group["prompts"][prompt]:
+                        if not future.done():
+                            future.set_result(response)
+            except Exception as e:
+                self.n_errors += 1
+                self.fail(futures, e)
+            # no request of the group may be left waiting once it is done
+            self.fail(futures, RuntimeError("The request was not answered"))
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        uptime = time.time() - self.started_at
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+
+        return {
+            "uptime": uptime,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "requests": self.n_requests,
+            "rejected": self.n_rejected,
+            "errors": self.n_errors,
+            "generated": self.n_generated,
+            "batches": self.n_batches,
+            "avg_batch_size": self.n_generated / self.n_batches if self.n_batches else None,
+            "throughput": self.n_requests / uptime if uptime > 0 else None,
+            "latency_ms": {"p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)},
+            "cache": self.cache.cache_info(),
+            "prefix_cache": self.lm.prefix_cache.cache_info() if getattr(self.lm, "prefix_cache", None) else None,
+        }
 
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
-)
+
+warnings.filterwarnings("ignore")
 
 parser = argparse.ArgumentParser("Server for Hugging Face models")
 parser.add_argument("--port", type=int, required=True, help="Server port")
 parser.add_argument("--model", type=str, required=True, help="Hugging Face model")
+parser.add_argument("--max_batch_size", type=int, default=16, help="Maximum number of requests per batch")
+parser.add_argument("--batch_window_ms", type=float, default=10.0, help="How long the first request of a batch waits for others")
+parser.add_argument("--max_queue_size", type=int, default=256, help="Maximum number of waiting requests before answering 503")
+parser.add_argument("--max_batch_tokens", type=int, default=8192, help="Token budget of a model micro-batch")
+parser.add_argument("--prefix_cache_size", type=int, default=0, help="Number of prompt prefixes whose KV cache is reused by causal models (0 disables it)")
+parser.add_argument("--cache_mb", type=int, default=256, help="Memory budget of the response cache (0 disables it)")
 args = parser.parse_args()
 # TODO: Convert this to a log message
 print(f"#> Loading the language model {args.model}")
-lm = HFModel(args.model)
+lm = HFModel(args.model, max_batch_tokens=args.max_batch_tokens, prefix_cache_size=args.prefix_cache_size)
+scheduler = BatchScheduler(lm,
+                           max_batch_size=args.max_batch_size,
+                           batch_window_ms=args.batch_window_ms,
+                           max_queue_size=args.max_queue_size,
+                           cache_bytes=args.cache_mb * 1024 * 1024)
+
+app = FastAPI()
+app.add_middleware(
+    CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]
+)
 
 
-@lru_cache(maxsize=None)
-def generate(prompt, **kwargs):
-    global lm
-    generateStart = time.time()
-    # TODO: Convert this to a log message
-    print(f'#> kwargs: "{kwargs}" (type={type(kwargs)})')
-    response = lm._generate(prompt, **kwargs)
-    # TODO: Convert this to a log message
-    print(f'#> Response: "{response}"')
-    latency = (time.time() - generateStart) * 1000.0
-    response["latency"] = latency
-    print(f'#> Latency:', '{:.3f}'.format(latency / 1000.0), 'seconds')
-    return response
+@app.on_event("startup")
+async def start_scheduler():
+    scheduler.start()
+
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
 
 
 @app.post("/")
 async def generate_post(query: Query):
-    return generate(query.prompt, **query.kwargs)
+    try:
+        return await scheduler.submit(query.prompt, query.kwargs)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Server is busy", headers={"Retry-After": "1"})
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return scheduler.metrics()
 
 
 if __name__ == "__main__":
@@ -1,8 +1,22 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from dsp.utils import batch
+
+
 class SentenceTransformersCrossEncoder:
     """Wrapper for sentence-transformers cross-encoder model.
+
+    Scores are cached per (query, passage) pair in a bounded LRU (`cache_size` pairs, 0 disables it)
+    and, if `cache_path` is given, in an SQLite file shared across runs. Only uncached pairs are
+    sent to the model.
     """
     def __init__(
-        self, model_name_or_path: str = "cross-encoder/ms-marco-MiniLM-L-12-v2"
+        self, model_name_or_path: str = "cross-encoder/ms-marco-MiniLM-L-12-v2",
+        cache_size: int = 100_000, cache_path: Optional[str] = None
     ):
         try:
             from sentence_transformers.cross_encoder import CrossEncoder
@@ -11,6 +25,88 @@ class SentenceTransformersCrossEncoder:
                 "You need to install sentence-transformers library to use SentenceTransformersCrossEncoder."
             )
         self.model = CrossEncoder(model_name_or_path)
+        self.model_name_or_path = model_name_or_path
+
+        self.cache_size = cache_size
+        self.cache: OrderedDict[bytes, float] = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.n_hits = 0
+        self.n_misses = 0
+
+        self.cache_db = None
+        if cache_path is not None:
+            self.cache_db = sqlite3.connect(cache_path, check_same_thread=False)
+            self.cache_db.execute("CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, score REAL)")
+            self.cache_db.commit()
 
     def __call__(self, query: str, passage: list[str]) -> list[float]:
-        return self.model.predict([[query, p] for p in passage]).tolist()
+        return self.score_pairs([[query, p] for p in passage])
+
+    def score_pairs(self, pairs: list[list[str]]) -> list[float]:
+        """Scores (query, passage) pairs that may come from different queries in one forward pass."""
+        if len(pairs) == 0:
+            return []
+
+        keys = [self._get_key(query, passage) for query, passage in pairs]
+        scores = self._lookup(keys)
+
+        uncached = OrderedDict()
+        for key, pair, score in zip(keys, pairs, scores):
+            if score is None and key not in uncached:
+                uncached[key] = pair
+
+        if uncached:
+            new_scores = dict(zip(uncached.keys(), self.model.predict(list(uncached.values())).tolist()))
+            self._store(new_scores)
+            scores = [new_scores[key] if score is None else score for key, score in zip(keys, scores)]
+
+        with self.cache_lock:
+            self.n_misses += len(uncached)
+            self.n_hits += len(pairs) - len(uncached)
+
+        return scores
+
+    def cache_info(self) -> dict[str, int]:
+        return {"hits": self.n_hits, "misses": self.n_misses, "size": len(self.cache)}
+
+    def _get_key(self, query: str, passage: str) -> bytes:
+        return hashlib.sha1("\0".join([self.model_name_or_path, query, passage]).encode("utf-8")).digest()
+
+    def _lookup(self, keys: list[bytes]) -> list[Optional[float]]:
+        scores = []
+        with self.cache_lock:
+            for key in keys:
+                score = self.cache.get(key)
+                if score is not None:
+                    self.cache.move_to_end(key)
+                scores.append(score)
+
+            if self.cache_db is not None and None in scores:
+                missing = list({key for key, score in zip(keys, scores) if score is None})
+                disk_scores = {}
+                for keys_batch in batch(missing, 500):
+                    rows = self.cache_db.execute(
+                        f"SELECT key, score FROM scores WHERE key IN ({','.join('?' * len(keys_batch))})",
+                        keys_batch,
+                    )
+                    disk_scores.update(rows.fetchall())
+                scores = [disk_scores.get(key) if score is None else score for key, score in zip(keys, scores)]
+                self._remember(disk_scores)
+
+        return scores
+
+    def _store(self, new_scores: dict[bytes, float]):
+        with self.cache_lock:
+            self._remember(new_scores)
+            if self.cache_db is not None:
+                self.cache_db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?)", new_scores.items())
+                self.cache_db.commit()
+
+    def _remember(self, new_scores: dict[bytes, float]):
+        if self.cache_size <= 0:
+            return
+        for key, score in new_scores.items():
+            self.cache[key] = score
+            self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
@@ -0,0 +1,220 @@
+"""
+Single-file request cache backed by SQLite (WAL mode), with the same `.cache` decorator as joblib's `Memory`.
+Selected in `cache_utils` when `DSP_CACHEDIR` points to a `.sqlite`/`.sqlite3`/`.db` file.
+
+To migrate an existing joblib cache:
+    python -m dsp.modules.sqlite_cache --joblib_dir ~/cachedir_joblib --sqlite_path ~/cachedir.sqlite
+"""
+
+import os
+import ast
+import json
+import time
+import pickle
+import hashlib
+import inspect
+import sqlite3
+import argparse
+import threading
+from functools import wraps
+
+
+def canonical_arguments(func, args, kwargs) -> dict:
+    """Binds a call to `func`'s signature, so positional and keyword calls map to the same entry."""
+    signature = inspect.signature(func)
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+
+    arguments = {}
+    for name, value in bound.arguments.items():
+        kind = signature.parameters[name].kind
+        if kind == inspect.Parameter.VAR_KEYWORD:
+            arguments.update(value)
+        elif kind == inspect.Parameter.VAR_POSITIONAL:
+            arguments['*'] = list(value)
+        else:
+            arguments[name] = value
+
+    return arguments
+
+
+def hash_arguments(arguments: dict) -> str:
+    try:
+        payload = json.dumps(arguments, sort_keys=True).encode('utf-8')
+    except TypeError:
+        payload = pickle.dumps(sorted(arguments.items()), protocol=4)
+
+    return hashlib.sha256(payload).hexdigest()
+
+
+def get_namespace(func) -> str:
+    return f"{func.__module__}.{func.__qualname__}"
+
+
+class SQLiteMemory:
+    """Key-value cache of function outputs in one SQLite file.
+
+    Unlike joblib, entries are not invalidated when the function's code changes.
+    Several processes can read concurrently; writes are serialized by SQLite.
+    """
+
+    def __init__(self, location: str, timeout: float = 60.0):
+        self.location = os.path.expanduser(location)
+        self.timeout = timeout
+        self.local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.location)), exist_ok=True)
+        conn = self.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "func TEXT, key TEXT, value BLOB, created REAL, PRIMARY KEY (func, key)"
+            ") WITHOUT ROWID"
+        )
+        conn.commit()
+
+    def connection(self) -> sqlite3.Connection:
+        """Returns a connection owned by the current thread and process."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.location, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, namespace: str, key: str):
+        row = self.connection().execute(
+            "SELECT value FROM cache WHERE func = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return False, None
+        return True, pickle.loads(row[0])
+
+    def contains(self, namespace: str, key: str) -> bool:
+        row = self.connection().execute(
+            "SELECT 1 FROM cache WHERE func = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return row is not None
+
+    def set(self, namespace: str, key: str, value):
+        self.set_many(namespace, [(key, value)])
+
+    def set_many(self, namespace: str, items):
+        conn = self.connection()
+        conn.executemany(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            [(namespace, key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time())
+             for key, value in items],
+        )
+        conn.commit()
+
+    def cache(self, func):
+        return SQLiteMemorizedFunc(func, self)
+
+
+class SQLiteMemorizedFunc:
+    """Callable returned by `SQLiteMemory.cache`, mirroring the parts of joblib's MemorizedFunc we use."""
+
+    def __init__(self, func, memory: SQLiteMemory):
+        self.func = func
+        self.memory = memory
+        self.namespace = get_namespace(func)
+        wraps(func)(self)
+
+    def _get_key(self, args, kwargs) -> str:
+        return hash_arguments(canonical_arguments(self.func, args, kwargs))
+
+    def __call__(self, *args, **kwargs):
+        key = self._get_key(args, kwargs)
+        found, output = self.memory.get(self.namespace, key)
+        if found:
+            return output
+
+        output = self.func(*args, **kwargs)
+        self.memory.set(self.namespace, key, output)
+        return output
+
+    def check_call_in_cache(self, *args, **kwargs) -> bool:
+        return self.memory.contains(self.namespace, self._get_key(args, kwargs))
+
+    def store(self, output, *args, **kwargs):
+        self.memory.set(self.namespace, self._get_key(args, kwargs), output)
+
+
+def iter_joblib_cache(joblib_dir: str, skipped: list = None):
+    """Yields (namespace, arguments, output) for every call stored in a joblib `Memory` location.
+    The directories of stored outputs that cannot be migrated are appended to `skipped`.
+    """
+    import joblib
+
+    root = os.path.join(os.path.expanduser(joblib_dir), 'joblib')
+    for dirpath, _, filenames in os.walk(root):
+        if 'output.pkl' not in filenames:
+            continue
+        if 'metadata.json' not in filenames:
+            # the arguments of the call are only recorded there
+            if skipped is not None:
+                skipped.append(dirpath)
+            continue
+
+        func_dir = os.path.dirname(dirpath)
+        namespace = '.'.join(os.path.relpath(func_dir, root).split(os.sep))
+
+        with open(os.path.join(dirpath, 'metadata.json')) as f:
+            input_args = json.load(f)['input_args']
+
+        # joblib stores reprs of the arguments; **kwargs are recorded as one dict under '**'
+        try:
+            arguments = {}
+            for name, value_repr in input_args.items():
+                value = ast.literal_eval(value_repr)
+                if name == '**':
+                    arguments.update(value)
+                elif name == '*':
+                    arguments['*'] = list(value)
+                else:
+                    arguments[name] = value
+        except (ValueError, SyntaxError):
+            print(f"#> Skipping {dirpath}: arguments are not literals")
+            if skipped is not None:
+                skipped.append(dirpath)
+            continue
+
+        yield namespace, arguments, joblib.load(os.path.join(dirpath, 'output.pkl'))
+
+
+def migrate_joblib_cache(joblib_dir: str, sqlite_path: str, batch_size: int = 1000) -> tuple[int, int]:
+    """Returns the number of migrated and of skipped cached calls."""
+    memory = SQLiteMemory(sqlite_path)
+
+    n_migrated = 0
+    pending = {}
+    skipped = []
+    for namespace, arguments, output in iter_joblib_cache(joblib_dir, skipped=skipped):
+        pending.setdefault(namespace, []).append((hash_arguments(arguments), output))
+        n_migrated += 1
+
+        if len(pending[namespace]) >= batch_size:
+            memory.set_many(namespace, pending.pop(namespace))
+
+    for namespace, items in pending.items():
+        memory.set_many(namespace, items)
+
+    return n_migrated, len(skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser("Migrate a joblib request cache into a single SQLite file")
+    parser.add_argument("--joblib_dir", default=os.path.join(os.path.expanduser('~'), 'cachedir_joblib'), type=str, help="The joblib Memory location to read.")
+    parser.add_argument("--sqlite_path", default=None, type=str, required=True, help="The SQLite cache file to write.")
+    args = parser.parse_args()
+
+    n_migrated, n_skipped = migrate_joblib_cache(args.joblib_dir, args.sqlite_path)
+    print(f"#> Migrated {n_migrated} cached calls into {args.sqlite_path}")
+    if n_skipped:
+        print(f"#> Skipped {n_skipped} cached calls without readable arguments (missing metadata.json or non-literal arguments)")
+
+
+if __name__ == "__main__":
+    main()
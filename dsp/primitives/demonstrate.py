@@ -1,5 +1,8 @@
 import random
-from typing import Callable, Any
+import functools
+import threading
+from collections import OrderedDict
+from typing import Callable, Any, Optional
 
 import numpy as np
 
@@ -126,12 +129,69 @@ def answer_match(prediction, answers, frac=1.0):
     return F1(prediction, answers) >= frac
 
 
+class AnswerMatcher:
+    """Answer-in-passage matcher that gives the same result as `has_answer`.
+
+    Each passage is normalized and tokenized once and kept in a bounded LRU (`max_passages`),
+    together with hashed sets of its n-grams, so checking all answers is one set lookup per
+    distinct answer length instead of a scan over the passage per answer.
+    """
+
+    def __init__(self, max_passages: int = 50_000, max_answers: int = 50_000):
+        self.max_passages = max_passages
+        self.passages: OrderedDict[str, tuple[tuple[str, ...], dict[int, set]]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.tokenize_answer = functools.lru_cache(maxsize=max_answers)(self.tokenize)
+
+    @staticmethod
+    def tokenize(text: str) -> tuple[str, ...]:
+        return tuple(DPR_normalize(normalize_text(text)))
+
+    def _get_passage(self, passage: str):
+        with self.lock:
+            entry = self.passages.get(passage)
+            if entry is not None:
+                self.passages.move_to_end(passage)
+                return entry
+
+        entry = (self.tokenize(passage), {})
+
+        with self.lock:
+            self.passages[passage] = entry
+            while len(self.passages) > self.max_passages:
+                self.passages.popitem(last=False)
+
+        return entry
+
+    def __call__(self, passage: str, answers: list[str]) -> bool:
+        tokens, ngrams = self._get_passage(passage)
+
+        answers_by_len: dict[int, set] = {}
+        for answer in answers:
+            answer_tokens = self.tokenize_answer(answer)
+            if len(answer_tokens) == 0:
+                # has_answer trivially matches an empty answer
+                return True
+            if len(answer_tokens) <= len(tokens):
+                answers_by_len.setdefault(len(answer_tokens), set()).add(answer_tokens)
+
+        for n, answer_set in answers_by_len.items():
+            passage_ngrams = ngrams.get(n)
+            if passage_ngrams is None:
+                passage_ngrams = set(zip(*(tokens[i:] for i in range(n))))
+                ngrams[n] = passage_ngrams
+            if not passage_ngrams.isdisjoint(answer_set):
+                return True
+
+        return False
+
+
+answer_matcher = AnswerMatcher()
+
+
 def passage_has_answers(passage: str, answers: list[str]) -> bool:
     """Returns True if the passage contains the answer."""
-    return has_answer(
-        tokenized_answers=[DPR_normalize(normalize_text(ans)) for ans in answers],
-        text=normalize_text(passage),
-    )
+    return answer_matcher(passage, answers)
 
 
 def cast_naive_get_only_question_text(inp_example: Example) -> Example:
@@ -160,7 +220,8 @@ def knn(
 ) -> Callable[[Example, int], list[Example]]:
     """
     A function that vectorizes train data using `dsm.settings.vectorizer`, then build an ANN/KNN
-    index to search similar questions among `train` samples.
+    index to search similar questions among `train` samples. If `dsp.settings.embedding_store`
+    is set, train vectors are loaded from (or saved to) that store instead of being re-encoded.
 
     Args:
         train: a bunch of questions to put in index & search later
@@ -176,7 +237,11 @@ def knn(
     train_casted_to_vectorize = [cast(cur_elem) for cur_elem in train]
 
     vectorizer: "BaseSentenceVectorizer" = dsp.settings.vectorizer
-    all_vectors = vectorizer(train_casted_to_vectorize).astype(np.float32)
+    if dsp.settings.embedding_store:
+        # memory-mapped reload of previously computed train vectors
+        all_vectors = dsp.settings.embedding_store.vectorize(vectorizer, train_casted_to_vectorize)
+    else:
+        all_vectors = vectorizer(train_casted_to_vectorize).astype(np.float32)
 
     index = create_faiss_index(
         emb_dim=all_vectors.shape[1], n_objects=len(train), **knn_args
@@ -184,10 +249,24 @@ def knn(
     index.train(all_vectors)
     index.add(all_vectors)
 
-    def inner_knn_search(inp_example: Example, k: int) -> list[Example]:
+    def inner_knn_search(
+        inp_example: Example, k: int, exclude: Optional[np.ndarray] = None
+    ) -> list[Example]:
+        """
+        `exclude` is an optional boolean mask over `train`. Masked samples are skipped, so
+        callers can drop demos without rebuilding the index.
+        """
+        n_search = k
+        if exclude is not None:
+            n_search = min(k + int(exclude.sum()), len(train))
+
         inp_example_vector = vectorizer([cast(inp_example)])
-        _, nearest_samples_idxs = index.search(inp_example_vector, k)
-        train_sampled = [train[cur_idx] for cur_idx in nearest_samples_idxs[0]]
+        _, nearest_samples_idxs = index.search(inp_example_vector, n_search)
+        nearest_samples_idxs = [
+            cur_idx for cur_idx in nearest_samples_idxs[0]
+            if cur_idx >= 0 and (exclude is None or not exclude[cur_idx])
+        ]
+        train_sampled = [train[cur_idx] for cur_idx in nearest_samples_idxs[:k]]
         return train_sampled
 
     return inner_knn_search
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import weakref
+
+import aiohttp
+
+
+class AioSessionPool:
+    """One `aiohttp.ClientSession` (and request semaphore) per event loop, each closed on its own loop.
+
+    A session only works on the loop that created it, so a client used from several `asyncio.run`
+    calls gets a new session in each. Every session is watched by a task that closes it when the loop
+    cancels its remaining tasks at shutdown (as `asyncio.run` does), or when `aclose` is called.
+
+    Args:
+        max_concurrent_requests (int): connection pool size and maximum number of in-flight requests.
+        timeout (float, optional): total timeout of a request in seconds. Defaults to 600.
+    """
+
+    def __init__(self, max_concurrent_requests: int, timeout: float = 600):
+        self.max_concurrent_requests = max_concurrent_requests
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.states = weakref.WeakKeyDictionary()  # loop -> (session, semaphore, closer task)
+
+    def get(self) -> tuple[aiohttp.ClientSession, asyncio.Semaphore]:
+        """Returns the session and semaphore bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            state = self.states.get(loop)
+            if state is None or state[0].closed:
+                connector = aiohttp.TCPConnector(limit=self.max_concurrent_requests)
+                session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+                semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+                closer = loop.create_task(self._close_on_cancel(session))
+                state = self.states[loop] = (session, semaphore, closer)
+
+        return state[0], state[1]
+
+    @staticmethod
+    async def _close_on_cancel(session: aiohttp.ClientSession):
+        try:
+            await asyncio.get_running_loop().create_future()
+        finally:
+            await session.close()
+
+    async def aclose(self):
+        """Closes the session of the running loop, and asks loops running in other threads to close theirs."""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            states = list(self.states.items())
+            self.states.clear()
+
+        for session_loop, (_, _, closer) in states:
+            if session_loop is loop:
+                closer.cancel()
+                await asyncio.gather(closer, return_exceptions=True)
+            elif session_loop.is_running():
+                session_loop.call_soon_threadsafe(closer.cancel)
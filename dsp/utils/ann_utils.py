@@ -78,6 +78,31 @@ def _get_ivf_index(
     return index
 
 
+def _get_ivfpq_index(
+    emb_dim: int,
+    n_objects: int,
+    pq_m: int,
+    centroid_dist_type: str
+) -> Index:
+    n_list = int(4 * (n_objects ** 0.5))
+
+    if centroid_dist_type.lower() == 'ip':
+        quannizer = faiss.IndexFlatIP(emb_dim)
+        centroid_metric = faiss.METRIC_INNER_PRODUCT
+    elif centroid_dist_type.lower() == 'l2':
+        quannizer = faiss.IndexFlatL2(emb_dim)
+        centroid_metric = faiss.METRIC_L2
+    else:
+        raise ValueError(f'Wrong distance type for FAISS index: {centroid_dist_type}')
+
+    if emb_dim % pq_m != 0:
+        raise ValueError(f'Embedding size {emb_dim} is not divisible by the number of PQ sub-quantizers {pq_m}')
+
+    # 8 bits per sub-quantizer code
+    index = faiss.IndexIVFPQ(quannizer, emb_dim, n_list, pq_m, 8, centroid_metric)
+    return index
+
+
 def create_faiss_index(
     emb_dim: int,
     n_objects: int,
@@ -85,7 +110,8 @@ def create_faiss_index(
     max_gpu_devices: int = 0,
     encode_residuals: bool = True,
     in_list_dist_type: str = 'L2',
-    centroid_dist_type: str = 'L2'
+    centroid_dist_type: str = 'L2',
+    pq_m: int = 0
 ) -> Index:
     """
     Create IVF index (with IP or L2 dist), without adding data and training
@@ -106,12 +132,21 @@ def create_faiss_index(
         centroid_dist_type: type of distance to calculate simmilarities between a query 
             and cluster centroids. Can be `IP` (for inner product) or `L2` distance.
             Case insensetive.
+        pq_m: if positive, compress IVF lists with product quantization using `pq_m` sub-quantizers
+            (IVF-PQ) instead of fp16 scalar quantization. Ignored for bruteforce indexes.
     Returns: untrained FAISS-index
     """
     if n_objects < 20_000:
         # if less than 20_000 / (4 * sqrt(20_000)) ~= 35 points per cluster - make bruteforce
         # https://github.com/facebookresearch/faiss/wiki/Guidelines-to-choose-an-index#if-below-1m-vectors-ivfk
         index = _get_brute_index(emb_dim=emb_dim, dist_type=in_list_dist_type)
+    elif pq_m > 0:
+        index = _get_ivfpq_index(
+            emb_dim=emb_dim,
+            n_objects=n_objects,
+            pq_m=pq_m,
+            centroid_dist_type=centroid_dist_type
+        )
     else:
         index = _get_ivf_index(
             emb_dim=emb_dim,
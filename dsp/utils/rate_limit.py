@@ -0,0 +1,79 @@
+import re
+import time
+import asyncio
+import threading
+from typing import Optional
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by threads and asyncio tasks.
+
+    Args:
+        rate (float): tokens refilled per second.
+        capacity (float, optional): maximum burst size. Defaults to `rate`.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, n: float = 1.0) -> float:
+        """Takes `n` tokens and returns how many seconds the caller has to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= n
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self, n: float = 1.0):
+        wait = self.reserve(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, n: float = 1.0):
+        wait = self.reserve(n)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update(self, remaining: float, reset_seconds: Optional[float] = None):
+        """Syncs the bucket with the server's view, e.g. from rate-limit response headers.
+
+        Nothing is available until the server's window resets, so the bucket is drained
+        to `remaining` and refilled at the rate implied by `reset_seconds`.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = min(self.tokens, remaining)
+            if reset_seconds and remaining <= 0:
+                self.tokens = min(self.tokens, -reset_seconds * self.rate)
+
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Parses durations such as `1s`, `6m0s` or `20ms` (OpenAI rate-limit headers) into seconds."""
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    matches = _DURATION_RE.findall(value)
+    if not matches:
+        return None
+
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
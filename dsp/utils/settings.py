@@ -1,7 +1,13 @@
 from contextlib import contextmanager
+from contextvars import ContextVar
 from dsp.utils.utils import dotdict
 
 
+# Configurations pushed by `Settings.context()`. Each thread and asyncio task sees its own
+# overlay on top of the process-wide stack, so concurrent pipelines cannot pop each other's config.
+_local_stack: ContextVar[tuple] = ContextVar("dsp_settings_local_stack", default=())
+
+
 class Settings(object):
     """DSP configuration settings."""
 
@@ -24,6 +30,7 @@ class Settings(object):
                 lm=None,
                 rm=None,
                 reranker=None,
+                embedding_store=None,
                 compiled_lm=None,
                 force_reuse_cached_compilation=False,
                 compiling=False,
@@ -34,6 +41,10 @@ class Settings(object):
 
     @property
     def config(self):
+        local_stack = _local_stack.get()
+        if local_stack:
+            return local_stack[-1]
+
         return self.stack[-1]
 
     def __getattr__(self, name):
@@ -48,30 +59,39 @@ class Settings(object):
     def __append(self, config):
         self.stack.append(config)
 
-    def __pop(self):
-        self.stack.pop()
+    def __make_config(self, inherit_config, kwargs):
+        if inherit_config:
+            return {**self.config, **kwargs}
+
+        return {**kwargs}
 
     def configure(self, inherit_config: bool = True, **kwargs):
         """Set configuration settings.
 
+        Called outside of any `context()`, this updates the process-wide configuration that every
+        thread sees. Inside a `context()`, it only updates the current context's configuration.
+
         Args:
             inherit_config (bool, optional): Set configurations for the given, and use existing configurations for the rest. Defaults to True.
         """
-        if inherit_config:
-            config = {**self.config, **kwargs}
-        else:
-            config = {**kwargs}
+        config = self.__make_config(inherit_config, kwargs)
 
-        self.__append(config)
+        local_stack = _local_stack.get()
+        if local_stack:
+            _local_stack.set(local_stack + (config,))
+        else:
+            self.__append(config)
 
     @contextmanager
     def context(self, inherit_config=True, **kwargs):
-        self.configure(inherit_config=inherit_config, **kwargs)
+        """Temporarily override configuration settings for the current thread or asyncio task."""
+        config = self.__make_config(inherit_config, kwargs)
+        token = _local_stack.set(_local_stack.get() + (config,))
 
         try:
             yield
         finally:
-            self.__pop()
+            _local_stack.reset(token)
 
     def __repr__(self) -> str:
         return repr(self.config)
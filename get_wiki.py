@@ -1,8 +1,34 @@
 import os
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-from toc import get_document, get_passages
+from toc import WikiDocumentPipeline, get_passages
+from toc.retrieval.wiki_dump import WikiDumpIndex
+from utils import build_jsonl_index
+
+def get_question_passages(pipeline, doc, max_psgs, lookahead, window=100, stride=None):
+    """Collects passages from the Wikipedia links of one question in rank order, until more than
+    `max_psgs` are found. Only the next `lookahead` documents are requested ahead of the one being read.
+    """
+    urls = [d['link'] for d in doc if "en.wikipedia.org" in d['link']]
+    futures = [pipeline.submit(url) for url in urls[:lookahead]]
+    
+    passages = []
+    n_fails = 0
+    for idx in range(len(urls)):
+        if idx + lookahead < len(urls):
+            futures += [pipeline.submit(urls[idx + lookahead])]
+        ret = futures[idx].result()
+        if isinstance(ret, Exception): 
+            n_fails += 1
+            continue
+        
+        psgs = get_passages(ret, window=window, stride=stride)
+        passages += psgs
+        if len(passages) > max_psgs: break
+    
+    return passages, n_fails
 
 def main():
     parser = argparse.ArgumentParser()
@@ -11,8 +37,16 @@ def main():
     parser.add_argument("--data_dir", default=None, type=str, required=True, help="The input data dir. Should contain the .json files for the task.")
     parser.add_argument("--data_name", default="output.json", type=str, help="The name of the input data file.")
     parser.add_argument("--top_k", default=100, type=int, help="The number of top-k documents to retrieve.")
-    parser.add_argument("--save_step", default=100, type=int, help="The number of steps to save the output.")
+    parser.add_argument("--save_step", default=100, type=int, help="The number of questions between flushes of passages.jsonl.")
     parser.add_argument("--debug", default=False, action="store_true", help="Whether to run in debug mode.")
+    parser.add_argument("--n_workers", default=8, type=int, help="The number of questions and page downloads processed concurrently.")
+    parser.add_argument("--n_procs", default=None, type=int, help="The number of processes extracting pages (defaults to the number of CPUs).")
+    parser.add_argument("--lookahead", default=4, type=int, help="The number of links per question requested ahead of the one being read.")
+    parser.add_argument("--cache_dir", default=None, type=str, help="The directory caching extracted pages by title (defaults to <data_dir>/wiki_cache).")
+    parser.add_argument("--window", default=100, type=int, help="The maximum number of words per passage.")
+    parser.add_argument("--stride", default=None, type=int, help="The number of words between passage starts; smaller than --window for overlapping passages.")
+    parser.add_argument("--wiki_index", default=None, type=str, help="The SQLite index built by toc.retrieval.wiki_dump from a local dump, used instead of fetching pages online.")
+    parser.add_argument("--follow_redirects", default=False, action='store_true', help="Read the target page of a redirect link from --wiki_index, instead of its stub as the live site returns.")
     parser.add_argument(
         "--output_dir", default=None, type=str, required=True, help="The output directory where the output files will be written.",)
     
@@ -23,36 +57,51 @@ def main():
     output_dir = os.path.join(args.data_dir, args.output_dir)
     os.makedirs(output_dir, exist_ok=True)
 
-    all_passages = []
+    # passages.jsonl holds one line per question, so run_toc can seek to single questions
+    jsonl_path = os.path.join(output_dir, "passages.jsonl")
+    f_jsonl = open(jsonl_path, 'w')
+    
+    if args.wiki_index is not None:
+        assert os.path.exists(args.wiki_index), f"{args.wiki_index} does not exist."
+        pipeline = WikiDumpIndex(args.wiki_index, follow_redirects=args.follow_redirects)
+    else:
+        cache_dir = args.cache_dir or os.path.join(args.data_dir, "wiki_cache")
+        pipeline = WikiDocumentPipeline(cache_dir=cache_dir, 
+                                        n_fetch_workers=args.n_workers, 
+                                        n_extract_workers=args.n_procs)
+    question_pool = ThreadPoolExecutor(max_workers=args.n_workers)
+    futures = [question_pool.submit(get_question_passages, pipeline, doc, args.top_k, args.lookahead, 
+                                    window=args.window, stride=args.stride) 
+               for doc in data]
+    
     n_fails = 0
-    max_psgs = args.top_k
-    for idx, doc in enumerate(data):
+    for idx, future in enumerate(futures):
         if (idx + 1) % 10 == 0:
             print(f"Processing {idx}th data...")
-        passages = []
-        for d in doc:
-            if "en.wikipedia.org" in d['link']:
-                url = d['link']
-                ret = get_document(url)
-                if type(ret) == Exception: 
-                    n_fails += 1
-                    continue
-                
-                psgs = get_passages(ret)
-                passages += psgs
-                if len(passages) > max_psgs: break
+        passages, n_doc_fails = future.result()
+        n_fails += n_doc_fails
         
-        all_passages += [passages]
+        f_jsonl.write(json.dumps(passages) + "\n")
         
         if (idx + 1) % args.save_step == 0:
-            with open(os.path.join(output_dir, f"passages_{str(idx+1)}.json"), 'w') as f:
-                json.dump(all_passages, f, indent=4)
-            print(f"Saved output_{idx}.json!")
+            f_jsonl.flush()
+            print(f"Saved {idx + 1} questions to {jsonl_path}!")
             if args.debug: break
         
     
-    with open(os.path.join(output_dir, f"passages.json"), 'w') as f:
-        json.dump(all_passages, f, indent=4)
+    question_pool.shutdown(cancel_futures=True)
+    pipeline.close()
+    print(f"Failed to get {n_fails} documents.")
+    
+    f_jsonl.close()
+    build_jsonl_index(jsonl_path)
+    
+    # the legacy .json list is streamed from the JSONL file, so the passages are never all held in memory
+    with open(jsonl_path) as f_in, open(os.path.join(output_dir, f"passages.json"), 'w') as f:
+        f.write("[\n")
+        for line_idx, line in enumerate(f_in):
+            f.write((",\n" if line_idx else "") + line.rstrip("\n"))
+        f.write("\n]\n")
         
         
 if __name__ == "__main__":
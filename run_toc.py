@@ -2,17 +2,22 @@ import os
 import json
 import dsp
 import argparse
+import contextvars
+import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 from toc import (
     rerank,
     parse_disambig, make_str_disambig,
     ToC, Node,
-    retrieve_passages,
+    DemoRetriever,
+    retrieve_pids,
+    PassageStore, get_source_info, save_pid_lists, load_pid_lists,
     get_rac_template,
-    check_unique, verify_with_evidence,
+    check_unique, verify_with_evidence_batch,
 )
-from utils import save_results
+from utils import save_results, ResultsJournal, JsonlIndex
 
 
 def get_dataset(args):
@@ -44,15 +49,13 @@ def get_dataset(args):
     return train, dev, data
 
 
-def get_example(args, train, ins, passages, 
+def get_example(args, demo_retriever, ins, passages, demo_mask=None,
                 reranker=None, consolidation=False):
     
     question = ins.question
-    with dsp.settings.context(vectorizer=dsp.SentenceTransformersVectorizer()):
-        knn_func = dsp.knn(train)
-        n_dynamic = args.n_shot
-        demos = knn_func(ins, n_dynamic)
-        demos.reverse()
+    n_dynamic = args.n_shot
+    demos = demo_retriever(ins, n_dynamic, demo_mask=demo_mask)
+    demos.reverse()
 
     dic_example = {'question': question,
                    'demos': demos,
@@ -84,54 +87,124 @@ def QD_predict(example: dsp.Example, qd_template,
     
     return out_example, completions
 
-def remove_demos(demos, target_ids):
-    new_demos = []
-    for demo in demos:
-        if demo.id not in target_ids:
-            new_demos += [demo]
-    return new_demos
-
-def remove_dup_demos(demos, lst_disambigs):
+def remove_dup_demos(demo_retriever, demo_mask, lst_disambigs):
     answers = []
     for disambig in lst_disambigs:
         answers += [disambig['answer']]
     
-    target_ids = []
-    for demo in demos:
-        demo_disambigs = parse_disambig(demo.disambig)
+    for idx, demo_disambigs in enumerate(demo_retriever.disambigs):
+        if demo_mask[idx]:
+            continue
         for da in demo_disambigs:
             if dsp.metrics.F1(da['answer'], answers) > 0.8:
-                target_ids += [demo.id]
-    
-    demos = remove_demos(demos, target_ids)
+                demo_mask[idx] = True
+                break
     
-    return demos
+    return demo_mask
 
-def remove_dup_psgs(passages, contexts, lst_disambigs):
+def remove_dup_psgs(passage_store, pids, context_pids, lst_disambigs):
     answers = []
     for disambig in lst_disambigs:
         answers += [disambig['answer']]
     
-    target_idxs = []
-    for idx, passage in enumerate(passages):
-        if passage in contexts and \
-            dsp.passage_has_answers(passage, answers):
-                target_idxs += [idx]
+    target_pids = [pid for pid in set(context_pids.tolist()) 
+                   if dsp.passage_has_answers(passage_store[pid], answers)]
+    
+    return pids[~np.isin(pids, target_pids)]
+
+def run_tree(args, idx, ambig_ins, demo_retriever, rac_template, passage_store,
+             bing_pids=None, **kw_args_ex):
+    """Builds the tree of clarifications for one ambiguous question and answers it.
+    All tree state (demo mask, passages, ToC) is local, so questions can run concurrently.
+    Passages are tracked as ids into `passage_store` and only turned into text for the prompts.
+    """
+    demo_mask = demo_retriever.new_mask()
+    lst_err = []
+    
+    all_pids = retrieve_pids(args, ambig_ins, passage_store, bing_pids=bing_pids)
+    cur_pids = all_pids
+    toc = ToC(root=Node(ambig_ins), passage_store=passage_store)
+    do_pruning = args.verify == True
+    n_restarts = 0 ; n_expansions = 0
+    
+    while n_restarts < args.max_trials and \
+        toc.n_nodes < args.max_nodes and \
+        n_expansions <= 15:
+        
+        n_expansions += 1
+        if toc.leaf_nodes == []:
+            toc.leaf_nodes = [toc.root]
+            toc.leaf_nodes += toc.valid_nodes
+            n_restarts += 1
+
+        cur_node = toc.leaf_nodes.pop(0)
+        cur_ins = cur_node.ins
+        if cur_node.depth > args.max_depth:
+            continue
+        
+        qd_example = get_example(args, demo_retriever, cur_ins, passage_store.get_many(cur_pids), 
+                                 demo_mask=demo_mask, **kw_args_ex)
+        context_pids = passage_store.add_many(qd_example.context)
+        toc.slt_psgs += context_pids.tolist()
+        qd_result, qd_completions = QD_predict(qd_example, rac_template, sc=False, temperature=args.temperature)
+        try:
+            lst_disambigs = parse_disambig(qd_result.disambig)
+            if lst_disambigs == []:
+                lst_disambigs = parse_disambig(qd_result.answer.split("\nAnswer:")[0])
+        except:
+            lst_disambigs = []
+            lst_err += [[idx, toc, qd_result.disambig]]
+        
+        if args.verify:
+            demo_mask = remove_dup_demos(demo_retriever, demo_mask, lst_disambigs)
+            cur_pids = remove_dup_psgs(passage_store, cur_pids, context_pids, lst_disambigs)
+            
+            if do_pruning:
+                unique_disambigs = [disambig for disambig in lst_disambigs 
+                                    if check_unique(toc.valid_qas, disambig)]
+                ver_completions = verify_with_evidence_batch(dsp.settings.lm, 
+                                                             toc, 
+                                                             unique_disambigs, 
+                                                             dsp.settings.reranker)
+                valid_disambigs = []
+                for disambig, ver_completion in zip(unique_disambigs, ver_completions):
+                    if "True" in ver_completion[0]:
+                        valid_disambigs += [disambig]
+                lst_disambigs = valid_disambigs.copy()
+        
+        if len(lst_disambigs) > 0:
+            toc.add_nodes(lst_disambigs, depth=cur_node.depth+1)
+            continue
+        
+        if do_pruning:
+            if n_restarts >= args.max_trials or n_expansions >= 10:    
+                n_restarts = 0
+                do_pruning = False
+                continue
+    
+    tree_ins = toc._get_tree(args.max_nodes)
+    
+    ac_example = get_example(args, demo_retriever, tree_ins, passage_store.get_many(all_pids), 
+                             demo_mask=demo_mask, consolidation=True, **kw_args_ex)
     
-    passages = [passage for idx, passage in enumerate(passages) if idx not in target_idxs]
+    ac_result, ac_completions = QD_predict(ac_example, rac_template, sc=False)
     
-    return passages
+    return ac_result.answer, ac_completions.data[0], lst_err
 
 def get_argparser():
     parser = argparse.ArgumentParser()
     # Required parameters
     parser.add_argument("--data_dir", default=None, type=str, required=True, help="The input data dir.")
     parser.add_argument("--data_name", default="ASQA.json", type=str, help="The input data name.")
-    parser.add_argument("--bing_path", default=None, type=str, help="The bing data path.")
+    parser.add_argument("--bing_path", default=None, type=str, help="The bing passages path (.json, or .jsonl read per question through its offset index).")
+    parser.add_argument("--passage_store_dir", default=None, type=str, help="The directory of the memory-mapped passage store, built from --bing_path if missing.")
     parser.add_argument("--prefix", default='', type=str, help="The prefix of output files.")
     parser.add_argument("--model_type", default='text-davinci-003', type=str, help="The GPT model type.")
     parser.add_argument("--openai_key",  default='', type=str, required=True, help="The openai key.")
-    parser.add_argument("--colbert_url", default='', type=str,required=True, help= "The colbert server url.")
+    parser.add_argument("--colbert_url", default='', type=str, help= "The colbert server url.")
+    parser.add_argument("--collection_path", default=None, type=str, help="The local passage collection (.tsv/.jsonl/.json) to retrieve from in-process instead of the colbert server.")
+    parser.add_argument("--index_path", default=None, type=str, help="The FAISS index file for the local collection, created if missing.")
+    parser.add_argument("--pq_m", default=0, type=int, help="The number of PQ sub-quantizers to compress large local indexes (0 to disable).")
     parser.add_argument("--temperature", default=0.7, type=float, help="The temperature for generation.")
     parser.add_argument("--n_shot", default=5, type=int, help="The number of few-shot examples for in-context learning.")
     parser.add_argument("--n_dev", default=-1, type=int, help="The number of dev examples to run.")
@@ -140,8 +213,14 @@ def get_argparser():
     parser.add_argument("--max_trials", default=3, type=int, help="The maximum number of restarts.")
     parser.add_argument("--top_k_docs", default=100, type=int, help="The maximum number of retrieved documents.")
     parser.add_argument("--top_k_reranked", default=5, type=int, help="The maximum number of reranked documents.")
-    parser.add_argument("--save_steps", default="", type=str, help="you can save intermediate results.")
+    parser.add_argument("--save_steps", default="", type=str, help="Comma-separated question counts to write output_N.json snapshots for, derived from the journal at the end.")
     parser.add_argument("--verify", default=False, action='store_true',)
+    parser.add_argument("--resume", default=False, action='store_true', help="Skip questions already recorded in the results journal of output_dir.")
+    parser.add_argument("--n_workers", default=1, type=int, help="The number of questions to process concurrently.")
+    parser.add_argument("--reranker", default="cross_encoder", choices=["cross_encoder", "cascade"], help="The reranker type. 'cascade' prunes passages with BM25 before the cross-encoder.")
+    parser.add_argument("--cascade_top_m", default=20, type=int, help="The number of BM25 survivors scored by the cross-encoder in the cascade reranker.")
+    parser.add_argument("--rerank_cache_path", default=None, type=str, help="The SQLite file to persist reranker scores across runs.")
+    parser.add_argument("--embedding_dir", default=None, type=str, help="The directory to store train question embeddings for reuse across runs.")
     parser.add_argument(
         "--output_dir",
         default=None,
@@ -157,24 +236,53 @@ def main():
     
     ## Set DSP configuration
     lm = dsp.GPT3(model=args.model_type, api_key=args.openai_key)
-    rm = dsp.ColBERTv2(url=args.colbert_server)
+    embedding_store = dsp.EmbeddingStore(args.embedding_dir) if args.embedding_dir is not None else None
+    if args.collection_path is not None:
+        rm = dsp.FaissRM(dsp.load_collection(args.collection_path), 
+                         embedding_store=embedding_store, 
+                         index_path=args.index_path, 
+                         pq_m=args.pq_m)
+    else:
+        assert args.colbert_url, "Either --colbert_url or --collection_path is required."
+        rm = dsp.ColBERTv2(url=args.colbert_url)
     kw_config = {'lm' : lm, 'rm' : rm}
+    if embedding_store is not None:
+        kw_config['embedding_store'] = embedding_store
 
     if args.top_k_reranked > 0:
-        kw_config['reranker'] = dsp.SentenceTransformersCrossEncoder()
+        reranker = dsp.SentenceTransformersCrossEncoder(cache_path=args.rerank_cache_path)
+        if args.reranker == "cascade":
+            reranker = dsp.CascadeReranker(reranker, top_m=args.cascade_top_m)
+        kw_config['reranker'] = reranker
 
     dsp.settings.configure(**kw_config)
     
     train, dev, data = get_dataset(args)
+    demo_retriever = DemoRetriever(train)
     rac_template = get_rac_template()
     
     kw_args_ex = {}
     if args.top_k_reranked > 0:
         kw_args_ex['reranker'] = dsp.settings.reranker
     
-    if args.bing_path is not None:
-        bing_results = json.load(open(args.bing_path))
-        assert len(bing_results) == len(dev)
+    bing_source = get_source_info(args.bing_path) if args.bing_path is not None else None
+    bing_passages = None ; bing_pids = None
+    if args.passage_store_dir is not None:
+        bing_pids = load_pid_lists(args.passage_store_dir, "bing", source=bing_source)
+    # a store saved for another bing file is rebuilt from scratch rather than extended
+    reuse_store = bing_pids is not None or args.bing_path is None
+    passage_store = PassageStore(args.passage_store_dir if reuse_store else None)
+    if bing_pids is None and args.bing_path is not None:
+        # a .jsonl file is read through its offset index, one question at a time
+        bing_passages = JsonlIndex(args.bing_path)
+        assert len(bing_passages) == len(dev)
+        if args.passage_store_dir is not None:
+            bing_pids = [passage_store.add_many(passages) for passages in bing_passages]
+            passage_store.save(args.passage_store_dir)
+            save_pid_lists(args.passage_store_dir, "bing", bing_pids, source=bing_source)
+            print(f"Saved {len(passage_store)} passages to {args.passage_store_dir}")
+    if bing_pids is not None:
+        assert len(bing_pids) == len(dev)
 
     if args.n_dev < 0:
         n_dev = len(dev)
@@ -184,93 +292,72 @@ def main():
     os.makedirs(args.output_dir, exist_ok=True)
     save_steps = [int(save_step) for save_step in args.save_steps.split(",")] if args.save_steps != "" else []
     
-    preds = [] ; outputs = []
+    journal = ResultsJournal(os.path.join(args.output_dir, args.prefix + "journal.jsonl"), resume=args.resume)
+    pending_idxs = [idx for idx in range(n_dev) if dev[idx].id not in journal.completed]
+    if len(pending_idxs) < n_dev:
+        print(f"Resuming: {n_dev - len(pending_idxs)} questions already completed.")
+    
+    def run_idx(idx):
+        if bing_pids is not None:
+            ins_bing_pids = bing_pids[idx]
+        elif bing_passages is not None:
+            ins_bing_pids = passage_store.add_many(bing_passages[idx])
+        else:
+            ins_bing_pids = None
+        pred, output, errs = run_tree(args, idx, dev[idx], demo_retriever, rac_template, passage_store,
+                                      bing_pids=ins_bing_pids, **kw_args_ex)
+        journal.append(dev[idx].id, pred, output)
+        return idx, errs
+    
     lst_err = []
-    bing_passages = None
-    for idx, ambig_ins in enumerate(tqdm(dev[:n_dev])):
-        cur_demos = train.copy()
-        if (idx + 1) % 10 == 0:
-            print(f"{str(idx +1)} steps")
-        
-        if args.bing_path is not None:
-            bing_passages = bing_results[idx]
-        
-        all_passages = retrieve_passages(args, ambig_ins, bing_passages=bing_passages)
-        cur_passages = all_passages.copy()
-        toc = ToC(root=Node(ambig_ins))
-        do_pruning = args.verify == True
-        n_restarts = 0 ; n_expansions = 0
-        
-        while n_restarts < args.max_trials and \
-            toc.n_nodes < args.max_nodes and \
-            n_expansions <= 15:
-            
-            n_expansions += 1
-            if toc.leaf_nodes == []:
-                toc.leaf_nodes = [toc.root]
-                toc.leaf_nodes += toc.valid_nodes
-                n_restarts += 1
-
-            cur_node = toc.leaf_nodes.pop(0)
-            cur_ins = cur_node.ins
-            if cur_node.depth > args.max_depth:
-                continue
+    with ThreadPoolExecutor(max_workers=args.n_workers) as executor:
+        if args.n_workers > 1:
+            # each worker runs in a copy of the current dsp.settings context;
+            # results are collected in submission order
+            futures = [executor.submit(contextvars.copy_context().run, run_idx, idx) for idx in pending_idxs]
             
-            qd_example = get_example(args, cur_demos, cur_ins, cur_passages, **kw_args_ex)
-            toc.slt_psgs += qd_example.context
-            qd_result, qd_completions = QD_predict(qd_example, rac_template, sc=False, temperature=args.temperature)
-            try:
-                lst_disambigs = parse_disambig(qd_result.disambig)
-                if lst_disambigs == []:
-                    lst_disambigs = parse_disambig(qd_result.answer.split("\nAnswer:")[0])
-            except:
-                lst_err += [[idx, toc, qd_result.disambig]]
+            # the first failing question cancels the ones not started yet, wherever it is in the order
+            failed = []
+            def cancel_pending(future):
+                if not future.cancelled() and future.exception() is not None:
+                    failed.append(future)
+                    for other in futures:
+                        other.cancel()
+            for future in futures:
+                future.add_done_callback(cancel_pending)
             
-            if args.verify:
-                cur_demos = remove_dup_demos(cur_demos, lst_disambigs)
-                cur_passages = remove_dup_psgs(cur_passages, qd_example.context, lst_disambigs)
-                
-                if do_pruning:
-                    valid_disambigs = []
-                    for disambig in lst_disambigs:
-                        if check_unique(toc.valid_qas, disambig):
-                            ver_completion = verify_with_evidence(dsp.settings.lm, 
-                                                                toc, 
-                                                                disambig, 
-                                                                dsp.settings.reranker,
-                                                                all_passages)
-                            if "True" in ver_completion[0]:
-                                valid_disambigs += [disambig]
-                    lst_disambigs = valid_disambigs.copy()
+            def iter_results():
+                for future in futures:
+                    if future.cancelled() and failed:
+                        failed[0].result()
+                    yield future.result()
+            results = iter_results()
+        else:
+            results = map(run_idx, pending_idxs)
+        try:
+            for step, (idx, errs) in enumerate(tqdm(results, total=len(pending_idxs))):
+                if (step + 1) % 10 == 0:
+                    print(f"{str(step +1)} steps")
             
-            if len(lst_disambigs) > 0:
-                toc.add_nodes(lst_disambigs, depth=cur_node.depth+1)
-                continue
-            
-            if do_pruning:
-                if n_restarts >= args.max_trials or n_expansions >= 10:    
-                    n_restarts = 0
-                    do_pruning = False
-                    continue
-        
-        tree_ins = toc._get_tree(args.max_nodes)
-        
-        kw_args_ex.update({'consolidation': True})
-        ac_example = get_example(args, cur_demos, tree_ins, all_passages, **kw_args_ex)
-        
-        ac_result, ac_completions = QD_predict(ac_example, rac_template, sc=False)
-        
-        preds   += [ac_result.answer]
-        outputs += [ac_completions.data[0]]
-        
-        if (idx + 1) in save_steps:
-            with open(os.path.join(args.output_dir, f"output_{str(idx+1)}.json"), 'w') as f:
-                json.dump(outputs, f, indent=4)
-            print(f"Saved output_{idx}.json!")
+                lst_err += errs
+        except BaseException:
+            # stop at the first failing question instead of running every other pending one first
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    journal.close()
     
     lm.inspect_history(n=1)
     
+    preds   = [journal.completed[ins.id][0] for ins in dev[:n_dev]]
+    outputs = [journal.completed[ins.id][1] for ins in dev[:n_dev]]
     save_results(args, data, preds, outputs)
+    
+    # the journal holds every result as it finishes; the --save_steps snapshots are derived from it once
+    for save_step in save_steps:
+        if save_step <= n_dev:
+            with open(os.path.join(args.output_dir, f"output_{save_step}.json"), 'w') as f:
+                json.dump(outputs[:save_step], f, indent=4)
+            print(f"Saved output_{save_step}.json!")
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,9 @@
 from .retrieval.wiki_utils import *
 from .retrieval.combine import *
+from .retrieval.passage_store import *
 from .templates.load import *
 
+from .demos import *
 from .pruning import *
 from .rac import *
 from .tree import *
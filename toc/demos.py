@@ -0,0 +1,31 @@
+import numpy as np
+
+import dsp
+from .utils import parse_disambig
+
+
+class DemoRetriever:
+    """Few-shot demo retrieval over the train split.
+
+    The train questions are embedded and indexed once, then shared by every node
+    of every tree. Demos are removed per question through a boolean mask
+    (see `new_mask`) instead of rebuilding the index.
+    """
+    def __init__(self, train, vectorizer=None, **knn_args):
+        self.train = train
+        if vectorizer is None:
+            vectorizer = dsp.SentenceTransformersVectorizer()
+
+        with dsp.settings.context(vectorizer=vectorizer):
+            self.knn_func = dsp.knn(train, **knn_args)
+
+        self.disambigs = [parse_disambig(demo.disambig) for demo in train]
+
+    def __len__(self):
+        return len(self.train)
+
+    def new_mask(self):
+        return np.zeros(len(self.train), dtype=bool)
+
+    def __call__(self, ins, k, demo_mask=None):
+        return self.knn_func(ins, k, exclude=demo_mask)
@@ -1,8 +1,8 @@
 import dsp
-from dsp.utils import deduplicate
+from concurrent.futures import ThreadPoolExecutor
 
 from .templates.load import get_ver_prompt
-from .retrieval.combine import rerank
+from .retrieval.combine import rerank, rerank_batch
 
 def check_unique(valid_qas, cur_qa):
     is_unique = True
@@ -15,7 +15,7 @@ def check_unique(valid_qas, cur_qa):
     return is_unique
 
 def get_evidence(tree, cur_qa, reranker):
-    passages = deduplicate(tree.slt_psgs)
+    passages = tree.get_slt_passages()
     pos_passages = [passage for passage in passages \
                     if dsp.passage_has_answers(passage, cur_qa['answer'])]
     if len(pos_passages) == 0:
@@ -31,4 +31,35 @@ def verify_with_evidence(lm, tree, cur_qa, reranker):
     
     completion = lm(prompt)
     
-    return completion
\ No newline at end of file
+    return completion
+
+def get_evidence_batch(tree, cur_qas, reranker):
+    passages = tree.get_slt_passages()
+    lst_pos_passages = []
+    for cur_qa in cur_qas:
+        pos_passages = [passage for passage in passages \
+                        if dsp.passage_has_answers(passage, cur_qa['answer'])]
+        if len(pos_passages) == 0:
+            pos_passages = passages
+        lst_pos_passages += [pos_passages]
+    
+    questions = [cur_qa['question'] for cur_qa in cur_qas]
+    evidences = rerank_batch(reranker, questions, lst_pos_passages, 1)
+    
+    return evidences
+
+def verify_with_evidence_batch(lm, tree, cur_qas, reranker):
+    """Verifies all candidate disambiguations of one expansion.
+    Evidence is reranked in one pass and the verification prompts are sent concurrently.
+    """
+    if len(cur_qas) == 0:
+        return []
+    
+    evidences = get_evidence_batch(tree, cur_qas, reranker)
+    prompts = [get_ver_prompt(evidence[0], tree.root.ins.question, cur_qa) 
+               for evidence, cur_qa in zip(evidences, cur_qas)]
+    
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        completions = list(executor.map(lm, prompts))
+    
+    return completions
@@ -1,3 +1,4 @@
+import numpy as np
 import dsp
 
 def retrieve_passages(args, ins, bing_passages=None):
@@ -7,4 +8,13 @@ def retrieve_passages(args, ins, bing_passages=None):
     if bing_passages is not None:
         passages += bing_passages
     
-    return passages
\ No newline at end of file
+    return passages
+
+def retrieve_pids(args, ins, passage_store, bing_pids=None):
+    passages = dsp.retrieve(ins.question, k=args.top_k_docs)
+    pids = passage_store.add_many(passages)
+    
+    if bing_pids is not None:
+        pids = np.concatenate([pids, np.asarray(bing_pids, dtype=np.int32)])
+    
+    return pids
@@ -5,4 +5,22 @@ def rerank(reranker, query, passages, k):
     passages_cs_scores_sorted = np.argsort(passages_cs_scores)[::-1]
     passages = [passages[idx] for idx in passages_cs_scores_sorted]
     
-    return passages[:k]
\ No newline at end of file
+    return passages[:k]
+
+def rerank_batch(reranker, queries, lst_passages, k):
+    """Reranks one passage list per query, scoring all pairs in a single reranker call when supported."""
+    if not hasattr(reranker, "score_pairs"):
+        return [rerank(reranker, query, passages, k) for query, passages in zip(queries, lst_passages)]
+    
+    pairs = [[query, passage] for query, passages in zip(queries, lst_passages) for passage in passages]
+    scores = reranker.score_pairs(pairs)
+    
+    reranked = []
+    offset = 0
+    for passages in lst_passages:
+        passages_cs_scores = scores[offset:offset + len(passages)]
+        offset += len(passages)
+        passages_cs_scores_sorted = np.argsort(passages_cs_scores)[::-1]
+        reranked += [[passages[idx] for idx in passages_cs_scores_sorted][:k]]
+    
+    return reranked
@@ -0,0 +1,148 @@
+import os
+import json
+import mmap
+import hashlib
+import threading
+
+import numpy as np
+
+
+class PassageStore:
+    """Interns passages under integer ids, storing each distinct text once as UTF-8 in a text arena.
+
+    A store saved with `save` is reopened with the arena and its offsets memory-mapped, so loading
+    does not materialize the passages on the heap. Passages added afterwards (e.g. retrieved at run
+    time) go to an in-memory arena on top of the mapped one.
+
+    Keys are saved as raw (N, 16) uint8 rows: a numpy `S16` element drops trailing NUL bytes on read,
+    which would make some reloaded keys miss their text.
+    """
+    ARENA = "arena.bin"
+    OFFSETS = "offsets.npy"
+    KEYS = "keys.npy"
+    KEY_SIZE = 16
+
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.base_arena = b""
+        self.base_offsets = np.zeros(1, dtype=np.int64)
+        self.base_keys = np.zeros((0, self.KEY_SIZE), dtype=np.uint8)
+        self._pid_of = None
+
+        if path is not None and os.path.exists(os.path.join(path, self.OFFSETS)):
+            self.base_offsets = np.load(os.path.join(path, self.OFFSETS), mmap_mode='r')
+            self.base_keys = np.load(os.path.join(path, self.KEYS), mmap_mode='r')
+            if self.base_keys.dtype.kind == 'S': # stores saved before keys were kept as raw bytes
+                self.base_keys = self.base_keys.view(np.uint8).reshape(-1, self.KEY_SIZE)
+            if self.base_offsets[-1] > 0:
+                with open(os.path.join(path, self.ARENA), 'rb') as f:
+                    self.base_arena = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.n_base = len(self.base_offsets) - 1
+        self.arena = bytearray()
+        self.offsets = [0]
+        self.keys = []
+
+    @staticmethod
+    def get_key(text):
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=PassageStore.KEY_SIZE).digest()
+
+    @property
+    def pid_of(self):
+        # built on the first `add` rather than at load time, so opening a store to read passages stays cheap
+        if self._pid_of is None:
+            self._pid_of = {key.tobytes(): pid for pid, key in enumerate(self.base_keys)}
+        return self._pid_of
+
+    def __len__(self):
+        return self.n_base + len(self.keys)
+
+    def add(self, text):
+        key = self.get_key(text)
+        with self.lock:
+            pid = self.pid_of.get(key)
+            if pid is None:
+                pid = len(self)
+                self.arena += text.encode('utf-8')
+                self.offsets.append(len(self.arena))
+                self.keys.append(key)
+                self.pid_of[key] = pid
+        return pid
+
+    def add_many(self, texts):
+        return np.array([self.add(text) for text in texts], dtype=np.int32)
+
+    def __getitem__(self, pid):
+        pid = int(pid)
+        if pid < self.n_base:
+            start, end = self.base_offsets[pid], self.base_offsets[pid + 1]
+            return self.base_arena[start:end].decode('utf-8')
+
+        pid -= self.n_base
+        return self.arena[self.offsets[pid]:self.offsets[pid + 1]].decode('utf-8')
+
+    def get_many(self, pids):
+        return [self[pid] for pid in pids]
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            # written aside and swapped in, so an arena mapped from the same path stays valid
+            arena_path = os.path.join(path, self.ARENA)
+            with open(arena_path + ".tmp", 'wb') as f:
+                f.write(self.base_arena[:self.base_offsets[-1]])
+                f.write(self.arena)
+            os.replace(arena_path + ".tmp", arena_path)
+            offsets = np.concatenate([
+                np.asarray(self.base_offsets, dtype=np.int64),
+                np.asarray(self.offsets[1:], dtype=np.int64) + self.base_offsets[-1],
+            ])
+            keys = np.concatenate([
+                np.asarray(self.base_keys, dtype=np.uint8),
+                np.frombuffer(b"".join(self.keys), dtype=np.uint8).reshape(-1, self.KEY_SIZE),
+            ])
+        # the arrays may be memory-mapped from the same path as well
+        save_array(os.path.join(path, self.OFFSETS), offsets)
+        save_array(os.path.join(path, self.KEYS), keys)
+
+
+def save_array(path, array):
+    """`np.save` to a temporary file swapped in afterwards, so a memory map of `path` is never rewritten in place."""
+    with open(path + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def get_source_info(path):
+    """Identifies the file pid lists were built from, so they are not reused for another one."""
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def save_pid_lists(path, name, lst_pids, source=None):
+    """Saves one pid array per entry (e.g. per question) as a flat array plus offsets.
+    `source` (see `get_source_info`) records the file the passages came from.
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f"{name}_source.json"), 'w') as f:
+        json.dump(source, f)
+    lengths = [len(pids) for pids in lst_pids]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    flat = np.concatenate(lst_pids).astype(np.int32) if lst_pids else np.zeros(0, dtype=np.int32)
+    save_array(os.path.join(path, f"{name}_offsets.npy"), offsets)
+    save_array(os.path.join(path, f"{name}_pids.npy"), flat)
+
+
+def load_pid_lists(path, name, source=None):
+    """Returns the saved pid arrays, or None if there are none or they were built from another `source`."""
+    if not os.path.exists(os.path.join(path, f"{name}_offsets.npy")):
+        return None
+    if source is not None:
+        source_path = os.path.join(path, f"{name}_source.json")
+        saved_source = json.load(open(source_path)) if os.path.exists(source_path) else None
+        if saved_source != source:
+            print(f"The {name} pid lists in {path} were built from {saved_source}, not {source['path']}; rebuilding them.")
+            return None
+    offsets = np.load(os.path.join(path, f"{name}_offsets.npy"))
+    flat = np.load(os.path.join(path, f"{name}_pids.npy"), mmap_mode='r')
+    return [flat[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
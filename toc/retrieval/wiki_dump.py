@@ -0,0 +1,161 @@
+"""
+Offline alternative to fetching pages from the live site: streams a local `pages-articles` dump
+(optionally bz2-compressed) through `collect_pages` and `extract_page` in a process pool, and writes
+a SQLite title -> document index that `get_wiki.py --wiki_index` reads instead of the network.
+
+    python -m toc.retrieval.wiki_dump --dump_path enwiki-latest-pages-articles.xml.bz2 --index_path enwiki.sqlite
+"""
+
+import re
+import bz2
+import json
+import sqlite3
+import argparse
+import itertools
+import threading
+from urllib.parse import unquote
+from multiprocessing import Pool
+from concurrent.futures import Future
+
+from .wiki_utils import collect_pages, extract_page
+
+redirectRE = re.compile(r'^\s*#redirect\s*:?\s*\[\[([^\]|#]+)', re.IGNORECASE)
+
+
+def normalize_title(title):
+    """Maps a URL title (`Foo_bar%27s#History`) and a dump title (`Foo bar's`) to the same key."""
+    title = unquote(title).split('#')[0].replace('_', ' ').strip()
+    return title[:1].upper() + title[1:]
+
+
+def open_dump(dump_path):
+    if dump_path.endswith('.bz2'):
+        return bz2.open(dump_path, 'rt', encoding='utf-8')
+    return open(dump_path, encoding='utf-8')
+
+
+def _extract_job(job):
+    id, revid, title, page, min_passage_length = job
+    match = redirectRE.match(page[0]) if page else None
+    target = normalize_title(match.group(1)) if match else None
+
+    # a redirect is extracted too: the live site exports its stub rather than the target page
+    # pages exported from the live site reach the extractor without line breaks (see `extract_document`),
+    # and the section splitting relies on that
+    page = [line.rstrip('\n') for line in page]
+    try:
+        doc = extract_page(id, revid, '', title, page, min_passage_length=min_passage_length)
+    except Exception as e:
+        doc = e
+    if isinstance(doc, Exception):
+        return title, None, target
+    return title, doc, target
+
+
+class WikiDumpIndex:
+    """SQLite index of extracted documents keyed by normalized title.
+    Like the live `fetch_page` (Special:Export), a redirect title returns the extracted redirect stub;
+    with `follow_redirects` it returns the target page instead.
+    Connections are opened per thread, so lookups can run from concurrent workers.
+    """
+    def __init__(self, index_path, follow_redirects=False):
+        self.index_path = index_path
+        self.follow_redirects = follow_redirects
+        self.local = threading.local()
+
+        conn = self.connection()
+        conn.execute("CREATE TABLE IF NOT EXISTS pages (title TEXT PRIMARY KEY, doc TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS redirects (title TEXT PRIMARY KEY, target TEXT)")
+        conn.commit()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.index_path)
+            self.local.conn = conn
+        return conn
+
+    def add_many(self, pages, redirects):
+        conn = self.connection()
+        conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?)",
+                         [(normalize_title(title), json.dumps(doc)) for title, doc in pages])
+        conn.executemany("INSERT OR REPLACE INTO redirects VALUES (?, ?)",
+                         [(normalize_title(title), target) for title, target in redirects])
+        conn.commit()
+
+    def get_document(self, url):
+        """Same contract as `wiki_utils.get_document`: the document, or an Exception if it is not indexed."""
+        title = normalize_title(url.split('/')[-1])
+        conn = self.connection()
+        if self.follow_redirects: # at most one hop, as double redirects are not followed by the wiki either
+            row = conn.execute("SELECT target FROM redirects WHERE title = ?", (title,)).fetchone()
+            if row is not None:
+                title = row[0]
+
+        row = conn.execute("SELECT doc FROM pages WHERE title = ?", (title,)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+        return Exception(f'There is no wiki page named {title}!')
+
+    def submit(self, url):
+        """Resolved future of `get_document`, so the index can stand in for `WikiDocumentPipeline`."""
+        future = Future()
+        future.set_result(self.get_document(url))
+        return future
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+
+def build_index(dump_path, index_path, n_procs=None, min_passage_length=200, batch_size=10000):
+    index = WikiDumpIndex(index_path)
+
+    def iter_jobs():
+        with open_dump(dump_path) as f:
+            for id, revid, title, page in collect_pages(f):
+                yield (id, revid, title, page, min_passage_length)
+
+    n_pages = 0 ; n_redirects = 0
+    jobs = iter_jobs()
+    with Pool(processes=n_procs) as pool:
+        while True:
+            # Pool.imap reads its input eagerly, so the dump is fed in bounded slices
+            jobs_batch = list(itertools.islice(jobs, batch_size))
+            if not jobs_batch:
+                break
+
+            pages = [] ; redirects = []
+            for title, doc, target in pool.imap_unordered(_extract_job, jobs_batch, chunksize=16):
+                if doc is not None:
+                    pages += [(title, doc)]
+                if target is not None:
+                    redirects += [(title, target)]
+
+            index.add_many(pages, redirects)
+            n_pages += len(pages) ; n_redirects += len(redirects)
+            print(f"#> Indexed {n_pages} pages")
+
+    return index, n_pages, n_redirects
+
+
+def main():
+    parser = argparse.ArgumentParser("Index a Wikipedia XML dump for offline passage building")
+    parser.add_argument("--dump_path", default=None, type=str, required=True, help="The pages-articles dump (.xml or .xml.bz2).")
+    parser.add_argument("--index_path", default=None, type=str, required=True, help="The SQLite index file to write.")
+    parser.add_argument("--n_procs", default=None, type=int, help="The number of extraction processes (defaults to the number of CPUs).")
+    parser.add_argument("--min_passage_length", default=200, type=int, help="The minimum length of a section to keep.")
+    args = parser.parse_args()
+
+    index, n_pages, n_redirects = build_index(args.dump_path, args.index_path,
+                                             n_procs=args.n_procs,
+                                             min_passage_length=args.min_passage_length)
+    index.close()
+    print(f"#> Indexed {n_pages} pages and {n_redirects} redirects into {args.index_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,21 @@
 import random
 import requests
-import tempfile
 from bs4 import BeautifulSoup
 import re
+import io
 import os
 import json
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from wikiextractor.extract import Extractor, acceptedNamespaces
 
 templateNamespace = ''
 
 sys_random = random.SystemRandom()
 tagRE = re.compile(r'(.*?)<(/?\w+)[^>]*>(?:([^<]*)(<.*?>)?)?')
+headingRE = re.compile(r'[=]{2}[\w|\s]+[=]{2}')
+spaceRE = re.compile(r'(?:\s|={3,})+')
 
 
 def collect_pages(text):
@@ -70,14 +75,30 @@ def collect_pages(text):
             redirect = False
 
 
-def get_document(url, min_passage_length=200):
-    target_title = url.split('/')[-1]
+def get_title(url):
+    return url.split('/')[-1]
+
+
+def fetch_page(target_title, session=None):
+    """Downloads the Special:Export XML of a page. Returns an Exception on a failed request."""
     url = f"https://en.wikipedia.org/wiki/Special:Export/{target_title}"
-    response = requests.get(url)
+    response = (session or requests).get(url)
     if response.status_code != 200:
         return Exception(f'There is no wiki page named {target_title}!')
     
-    html = response.text
+    return response.text
+
+
+def get_document(url, min_passage_length=200):
+    html = fetch_page(get_title(url))
+    if type(html) == Exception:
+        return html
+    
+    return extract_document(html, min_passage_length=min_passage_length)
+
+
+def extract_document(html, min_passage_length=200):
+    """Extracts the sections of an exported page (the CPU-heavy half of `get_document`)."""
     soup = BeautifulSoup(html, 'html.parser')
     text = str(soup)
     input = text.split('\n')
@@ -91,66 +112,187 @@ def get_document(url, min_passage_length=200):
         
     if not jobs:
         return Exception('Bad Document error!')
-        
-    e = Extractor(*jobs[0][:-1])
-    e.to_json = True
     
-    with tempfile.TemporaryFile('w+') as tmp_f:
-        e.extract(tmp_f)
-        tmp_f.seek(os.SEEK_SET)
-        page = json.load(tmp_f)
+    return extract_page(*jobs[0][:-1], min_passage_length=min_passage_length)
+
+
+def iter_sections(text):
+    """Splits extracted text at `==Heading==` markers in one pass, yielding (subtitle, passage) with
+    whitespace and `===` runs collapsed. The text before the first heading has subtitle None.
+    """
+    subtitle = None
+    start = 0
+    for m in headingRE.finditer(text):
+        yield subtitle, spaceRE.sub(' ', text[start:m.start()]).strip()
+        subtitle = m.group().strip('= ')
+        start = m.end()
+    
+    yield subtitle, spaceRE.sub(' ', text[start:]).strip()
+
+
+def extract_page(id, revid, urlbase, title, page, min_passage_length=200):
+    """Extracts the sections of one page yielded by `collect_pages`."""
+    e = Extractor(id, revid, urlbase, title, page)
+    e.to_json = True
     
-    tmp = re.sub(r'[=]{2}[\w|\s]+[=]{2}', '[SEP]', page['text'])
-    subtitles = [s.strip('= ') for s in re.findall(r'[=]{2}[\w|\s]+[=]{2}', page['text'])]
+    out = io.StringIO()
+    e.extract(out)
+    page = json.loads(out.getvalue())
     
     passages = {}
     used_subtitles = []
-    for idx, passage in enumerate(tmp.split('[SEP]')):
-        passage = re.sub(r'[=]{3,}', ' ', passage)
-        passage = re.sub(r'\s+', ' ', passage).strip()
-        
-        if idx == 0:
+    for subtitle, passage in iter_sections(page['text']):
+        if subtitle is None:
             passages['background'] = passage
             continue
         
         if len(passage) < min_passage_length:
             continue
             
-        passages[subtitles[idx-1]] = passage.strip('=')
-        used_subtitles.append(subtitles[idx-1])
+        passages[subtitle] = passage.strip('=')
+        used_subtitles.append(subtitle)
         
     return {
         'title': page['title'],
         'passages': passages,
         'subtitles': used_subtitles
     }
+
+
+
+class WikiPageCache:
+    """On-disk cache of extracted documents, one JSON file per page title.
+    Missing or broken pages are cached too, so they are not requested again.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
     
+    def get_path(self, title):
+        return os.path.join(self.cache_dir, hashlib.sha1(title.encode('utf-8')).hexdigest() + ".json")
     
-def get_passages(ret):
-    """_convert wikipedia documents into passages in DSP manner_
-    Args:
-        ret (_type_): _description_
-    Returns:
-        _type_: _description_
+    def get(self, title):
+        path = self.get_path(title)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            doc = json.load(f)
+        if 'error' in doc:
+            return Exception(doc['error'])
+        return doc
+    
+    def set(self, title, doc):
+        if type(doc) == Exception:
+            doc = {'error': str(doc)}
+        path = self.get_path(title)
+        with open(path + f".{os.getpid()}.{threading.get_ident()}.tmp", 'w') as f:
+            json.dump(doc, f)
+        os.replace(f.name, path)
+
+
+class WikiDocumentPipeline:
+    """Resolves Wikipedia links to documents with concurrent fetches over a pooled session and
+    extraction in a process pool. Each title is fetched at most once: repeated links share the
+    in-flight request, and finished documents are served from `WikiPageCache` when `cache_dir` is given.
+    
+    `submit(url)` returns a Future whose result follows `get_document`: the document, or an Exception.
     """
-    psgs = []
+    def __init__(self, cache_dir=None, n_fetch_workers=8, n_extract_workers=None, min_passage_length=200):
+        from requests.adapters import HTTPAdapter
+        
+        self.cache = WikiPageCache(cache_dir) if cache_dir is not None else None
+        self.min_passage_length = min_passage_length
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=n_fetch_workers, pool_maxsize=n_fetch_workers)
+        self.session.mount("https://", adapter)
+        self.fetch_pool = ThreadPoolExecutor(max_workers=n_fetch_workers)
+        self.extract_pool = ProcessPoolExecutor(max_workers=n_extract_workers)
+        
+        self.lock = threading.Lock()
+        self.futures = {}
+    
+    def submit(self, url):
+        title = get_title(url)
+        with self.lock:
+            future = self.futures.get(title)
+            if future is None:
+                future = Future()
+                self.futures[title] = future
+                # finished documents are only kept by their consumers (and the disk cache)
+                future.add_done_callback(lambda _: self._forget(title))
+                self.fetch_pool.submit(self._fetch, title, future)
+        
+        return future
+    
+    def _forget(self, title):
+        with self.lock:
+            self.futures.pop(title, None)
+    
+    def _fetch(self, title, future):
+        try:
+            doc = self.cache.get(title) if self.cache is not None else None
+            if doc is not None:
+                future.set_result(doc)
+                return
+            
+            html = fetch_page(title, session=self.session)
+            if type(html) == Exception: # failed requests may be transient, so they are not cached
+                future.set_result(html)
+                return
+            
+            extracted = self.extract_pool.submit(extract_document, html, self.min_passage_length)
+            extracted.add_done_callback(lambda f: self._on_extracted(title, future, f))
+        except Exception as e:
+            future.set_result(e)
+    
+    def _on_extracted(self, title, future, extracted):
+        try:
+            doc = extracted.result()
+            if self.cache is not None:
+                self.cache.set(title, doc)
+        except Exception as e:
+            doc = e
+        future.set_result(doc)
+    
+    def close(self):
+        self.fetch_pool.shutdown()
+        self.extract_pool.shutdown()
+        self.session.close()
+    
+    
+def iter_passages(ret, window=100, stride=None):
+    """Lazily chunks a document from `get_document` into passages of at most `window` words.
+    Each section is split into words once. With `stride` < `window`, consecutive chunks overlap.
+    """
+    stride = stride or window
     neg_titles = ["see also"]
     for sub_t, psg in ret['passages'].items():
         if sub_t.lower() in neg_titles: continue
         sub_t += "; "
         if sub_t == "background" + "; ":
             sub_t = ""
-
-        txt_psg = sub_t + psg
         
-        if len(txt_psg.split(" ")) > 100:
-            for i in range(0, len(psg.split(" ")), 100):
-                end_idx = min(i+100, len(psg.split(" ")))
-                txt_psg = sub_t + " ".join(psg.split(" ")[i:end_idx])
-                psgs += [txt_psg]
-        else:
-            psgs += [txt_psg]
-    
-    psgs = [ret['title'] + " | " + psg for psg in psgs]
-    
-    return psgs
\ No newline at end of file
+        prefix = ret['title'] + " | " + sub_t
+        words = psg.split(" ")
+        # number of words of sub_t + psg, counted without building the string
+        if len(sub_t.split(" ")) + len(words) - 1 <= window:
+            yield prefix + psg
+            continue
+        
+        for start in range(0, len(words), stride):
+            yield prefix + " ".join(words[start:start + window])
+            if start + window >= len(words):
+                break
+
+
+def get_passages(ret, window=100, stride=None):
+    """_convert wikipedia documents into passages in DSP manner_
+    Args:
+        ret (_type_): _description_
+        window (int): the maximum number of words per passage.
+        stride (int, optional): the number of words between passage starts. Defaults to window.
+    Returns:
+        _type_: _description_
+    """
+    return list(iter_passages(ret, window=window, stride=stride))
@@ -5,8 +5,9 @@ from .utils import make_str_disambig
 
 
 class ToC:
-    def __init__(self, root):
+    def __init__(self, root, passage_store=None):
         self.root = root
+        self.passage_store = passage_store # slt_psgs holds passage ids when given
         self.n_nodes = 0
         self.valid_qas = []
         self.valid_nodes = []
@@ -28,6 +29,13 @@ class ToC:
         
         for qa in qas:
             self.add_node(qa, depth)
+    
+    def get_slt_passages(self):
+        slt_psgs = deduplicate(self.slt_psgs)
+        if self.passage_store is not None:
+            slt_psgs = self.passage_store.get_many(slt_psgs)
+        
+        return slt_psgs
         
     def _get_tree(self, n_out_nodes):
         n_outs = min(len(self.valid_qas), n_out_nodes)
@@ -1,5 +1,8 @@
 import os
 import json
+import time
+import threading
+from array import array
 
 def save_results(args, data, preds, outputs):
     preds_w_ids = {}
@@ -18,5 +21,121 @@ def save_results(args, data, preds, outputs):
         
     with open(os.path.join(args.output_dir, args.prefix + "outputs.json"), 'w') as f:
         json.dump(outputs_w_ids, f)
+
+
+def write_jsonl_atomic(path, entries):
+    """Writes one JSON line per entry to a temporary file and swaps it in, so a crash keeps the old file."""
+    with open(path + ".tmp", 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+class ResultsJournal:
+    """Append-only JSONL journal with one line per finished question.
+    With `resume`, previously journaled questions are loaded into `completed` so they can be skipped.
+    Without it, an existing journal is moved aside rather than overwritten.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = {}
+        self.lock = threading.Lock()
+        
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError: # partially written last line
+                        continue
+                    self.completed[entry['id']] = (entry['pred'], entry['output'])
+            
+            # rewrite the valid entries so a truncated line never ends up in the middle of the file
+            write_jsonl_atomic(path, [{'id': id, 'pred': pred, 'output': output} 
+                                      for id, (pred, output) in self.completed.items()])
+        elif os.path.exists(path):
+            backup_path = f"{path}.{time.strftime('%Y%m%d-%H%M%S')}"
+            os.replace(path, backup_path)
+            print(f"Moved the existing journal to {backup_path} (pass --resume to continue it).")
         
+        self.f = open(path, 'a')
+    
+    def append(self, id, pred, output):
+        line = json.dumps({'id': id, 'pred': pred, 'output': output}) + "\n"
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.completed[id] = (pred, output)
+    
+    def close(self):
+        self.f.close()
+
+
+class JsonlIndex:
+    """Random access to a JSONL file (one entry per line) through a byte-offset index.
 
+    The index is stored next to the file as `<path>.idx` (native int64 offsets) and rebuilt
+    whenever it is missing or older than the file, so entries are parsed only when accessed.
+    A plain `.json` list is also accepted and loaded whole, for older outputs.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = None
+        
+        if not path.endswith(".jsonl"):
+            with open(path) as f:
+                self.entries = json.load(f)
+            return
+        
+        index_path = path + ".idx"
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+            self.offsets = array('q')
+            with open(index_path, 'rb') as f:
+                self.offsets.frombytes(f.read())
+        else:
+            self.offsets = build_jsonl_index(path)
+        
+        self.fd = os.open(path, os.O_RDONLY)
+    
+    def __len__(self):
+        if self.entries is not None:
+            return len(self.entries)
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, idx):
+        if self.entries is not None:
+            return self.entries[idx]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        
+        # pread does not move a shared file position, so concurrent workers can read safely
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return json.loads(os.pread(self.fd, end - start, start))
+    
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+    
+    def close(self):
+        if self.entries is None:
+            os.close(self.fd)
+
+
+def build_jsonl_index(path):
+    offsets = array('q', [0])
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                offsets.append(offsets[-1] + len(line))
+            else:
+                offsets[-1] += len(line) # skip blank lines
+    
+    with open(path + ".idx", 'wb') as f:
+        f.write(offsets.tobytes())
+    
+    return offsets